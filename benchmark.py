@@ -0,0 +1,319 @@
+"""
+Benchmarks for the simulation and generation hot paths.
+
+Runs parse_coil, slice_coil, calculate_field, produce_target_volume,
+helpers.optimize_points, helpers.chaikin, helpers.transform_many and pcb_json.dump_json
+on the coils in simulations/coils and on synthetic spiral coils of scalable size, and
+records wall time, peak memory and throughput to JSON.
+
+    python benchmark.py                      # everything, to benchmark_results.json
+    python benchmark.py -k field --repeat 5  # only benchmarks with "field" in the name
+    python benchmark.py --scale 4 -o big.json  # 4x larger synthetic coils and grids
+    python benchmark.py --compare old.json   # the speed-up against an earlier run
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+COILS = os.path.join(ROOT, "simulations", "coils")
+sys.path.insert(0, os.path.join(ROOT, "simulations"))
+
+import biot_savart_v4_3 as bs
+import helpers
+import pcb_json
+
+# the checked-in coils covering 2 and 4 layers of the custom and spiral shapes
+FIXTURES = [
+    "coil_12_custom-2-layer.csv",
+    "coil_12_custom-4-layer.csv",
+    "coil_12_spiral-2-layer.csv",
+    "coil_12_spiral-4-layer.csv",
+]
+
+
+def synthetic_spiral(n_points, turns=10, radius=1.0):
+    """
+    Returns an (n_points, 2) spiral in the xy plane, like the notebooks' get_spiral.
+    """
+    angle = np.linspace(0, 2 * np.pi * turns, n_points)
+    r = 0.1 * radius + 0.9 * radius * angle / angle[-1]
+    return np.column_stack((r * np.cos(angle), r * np.sin(angle)))
+
+
+def synthetic_coil(n_points, layers=2):
+    """
+    Returns a (4, n_points * layers) coil of stacked spirals carrying 0.5 A, in cm.
+    """
+    spiral = synthetic_spiral(n_points)
+    return np.concatenate(
+        [
+            np.column_stack(
+                (spiral, np.full(n_points, -0.011 * layer), np.full(n_points, 0.5))
+            )
+            for layer in range(layers)
+        ]
+    ).T
+
+
+def grid(n):
+    """
+    Returns the X, Y, Z meshgrid of n^3 points in a 4 cm box around the coil.
+    """
+    axis = np.linspace(-2, 2, n)
+    return np.meshgrid(axis, axis, axis, indexing="ij")
+
+
+def benchmarks(scale):
+    """
+    Returns a list of (name, setup) pairs. setup() prepares the inputs and returns
+    (run, work, unit): the function to time, the amount of work it does and its unit.
+    """
+    cases = []
+
+    for fixture in FIXTURES:
+        filename = os.path.join(COILS, fixture)
+
+        def parse(filename=filename):
+            n = bs.parse_coil(filename, cache=False).shape[1]
+            return (lambda: bs.parse_coil(filename, cache=False)), n, "vertices"
+
+        def parse_cached(filename=filename):
+            n = bs.parse_coil(filename).shape[1]
+            return (lambda: bs.parse_coil(filename)), n, "vertices"
+
+        def slice_(filename=filename):
+            coil = bs.parse_coil(filename)
+            n = bs.slice_coil(coil, 0.01).shape[1]
+            return (lambda: bs.slice_coil(coil, 0.01)), n, "vertices"
+
+        cases.append(("parse_coil[{}]".format(fixture), parse))
+        cases.append(("parse_coil_cached[{}]".format(fixture), parse_cached))
+        cases.append(("slice_coil[{}]".format(fixture), slice_))
+
+    n_grid = int(8 * scale)
+    for fixture in FIXTURES:
+        filename = os.path.join(COILS, fixture)
+        for method in ("richardson", "segment", "tree"):
+
+            def field(filename=filename, method=method):
+                coil = bs.parse_coil(filename)
+                if method == "richardson":
+                    coil = bs.slice_coil(coil, 0.05)
+                X, Y, Z = grid(n_grid)
+                work = (coil.shape[1] - 1) * X.size
+                return (
+                    lambda: bs.calculate_field(coil, X, Y, Z, method=method),
+                    work,
+                    "segment*points",
+                )
+
+            cases.append(("calculate_field[{},{}]".format(fixture, method), field))
+
+    n_synthetic = int(2000 * scale)
+    for method in ("richardson", "segment"):
+
+        def synthetic_field(method=method):
+            coil = synthetic_coil(n_synthetic)
+            if method == "richardson":
+                coil = bs.slice_coil(coil, 0.05)
+            X, Y, Z = grid(n_grid)
+            work = (coil.shape[1] - 1) * X.size
+            return (
+                lambda: bs.calculate_field(coil, X, Y, Z, method=method),
+                work,
+                "segment*points",
+            )
+
+        cases.append(
+            (
+                "calculate_field[synthetic-{},{}]".format(n_synthetic * 2, method),
+                synthetic_field,
+            )
+        )
+
+    def volume():
+        coil = bs.slice_coil(bs.parse_coil(os.path.join(COILS, FIXTURES[0])), 0.05)
+        size = 4 / max(n_grid - 1, 1)
+        n = len(bs.volume_axes((4, 4, 4), (-2, -2, -2), size)[0]) ** 3
+        return (
+            lambda: bs.produce_target_volume(coil, (4, 4, 4), (-2, -2, -2), size),
+            n,
+            "points",
+        )
+
+    cases.append(("produce_target_volume[{}]".format(FIXTURES[0]), volume))
+
+    n_track = int(10000 * scale)
+
+    def optimize():
+        points = [tuple(p) for p in synthetic_spiral(n_track)]
+        return (lambda: helpers.optimize_points(points)), n_track, "points"
+
+    def chaikin():
+        points = [tuple(p) for p in synthetic_spiral(n_track // 4)]
+        return (lambda: helpers.chaikin(points, 2)), n_track // 4 * 4, "points"
+
+    def stator():
+        # a 12 coil, 8 layer stator, every other group of 3 coils flipped (notebooks)
+        track = synthetic_spiral(n_track)
+        matrices = []
+        for i in range(12):
+            angle = i * 360 / 12
+            flip = [helpers.flip_y_matrix()] if (i // 3) % 2 else []
+            placement = helpers.compose(
+                *flip,
+                helpers.rotation_matrix(angle),
+                helpers.translation_matrix(20, angle),
+            )
+            matrices += [placement] * 8
+        return (lambda: helpers.transform_many(track, matrices)), n_track * 96, "points"
+
+    def dump():
+        track = [tuple(p) for p in synthetic_spiral(n_track)]
+        tracks = [{"net": "coils", "pts": track} for _ in range(6)]
+        filename = os.path.join(tempfile.mkdtemp(), "coils.json")
+        return (
+            lambda: pcb_json.dump_json(
+                filename=filename,
+                track_width=0.1,
+                pin_diam=1,
+                pin_drill=0.65,
+                via_diam=0.8,
+                via_drill=0.4,
+                vias=[],
+                pins=[],
+                pads=[],
+                silk=[],
+                tracks_f=tracks,
+                tracks_in=[tracks, tracks],
+                tracks_b=tracks,
+                mounting_holes=[],
+                edge_cuts=[],
+                components=[],
+            ),
+            n_track * 24,
+            "points",
+        )
+
+    cases.append(("helpers.optimize_points[{}]".format(n_track), optimize))
+    cases.append(("helpers.chaikin[{}]".format(n_track // 4), chaikin))
+    cases.append(("helpers.transform_many[{}]".format(n_track * 96), stator))
+    cases.append(("pcb_json.dump_json[{}]".format(n_track * 24), dump))
+    return cases
+
+
+def measure(run, repeat):
+    """
+    Returns the best wall time of repeat runs and the peak traced memory of another run.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    # numpy reports its allocations to tracemalloc, but tracing slows Python code down,
+    # so memory gets its own run
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def run_benchmarks(pattern=None, repeat=3, scale=1.0):
+    """
+    Runs the benchmarks whose name contains pattern and returns the results dict.
+    """
+    results = {}
+    for name, setup in benchmarks(scale):
+        if pattern and pattern not in name:
+            continue
+        run, work, unit = setup()
+        # warm up caches (and the parse_coil cache file) before timing
+        run()
+        seconds, peak = measure(run, repeat)
+        results[name] = {
+            "seconds": seconds,
+            "peak_bytes": peak,
+            "work": work,
+            "unit": unit,
+            "throughput": work / seconds if seconds > 0 else float("inf"),
+        }
+        print(
+            "{:<60} {:>10.4f} s {:>10.1f} MB {:>12.3g} {}/s".format(
+                name, seconds, peak / 1024**2, results[name]["throughput"], unit
+            )
+        )
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeat": repeat,
+            "scale": scale,
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline):
+    """
+    Prints the speed-up and memory change of every benchmark found in both runs.
+    """
+    print("\n{:<60} {:>10} {:>10}".format("compared to baseline", "speed-up", "memory"))
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]
+        memory = (
+            result["peak_bytes"] / before["peak_bytes"] if before["peak_bytes"] else 1
+        )
+        print(
+            "{:<60} {:>9.2f}x {:>9.2f}x".format(
+                name, before["seconds"] / result["seconds"], memory
+            )
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "-k", "--filter", help="only run benchmarks containing this text"
+    )
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="timed runs per benchmark"
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="size of the synthetic coils and grids"
+    )
+    parser.add_argument(
+        "--compare", help="results JSON of an earlier run to compare to"
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.filter, args.repeat, args.scale)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,29 @@ def get_arc_point(angle, radius):
     )
 
 
-# draw an arc
-def draw_arc(start_angle, end_angle, radius, step=5):
+# largest angle step (in degrees) along a curve of radius of curvature radius that keeps
+# the chords within tolerance, r (1 - cos(step / 2)) <= tolerance, capped at max_step
+def chord_step(radius, tolerance, max_step=45):
+    radius = np.asarray(radius, dtype=float)
+    with np.errstate(divide="ignore"):
+        cos_half = np.clip(1 - tolerance / radius, -1, 1)
+    return np.minimum(np.rad2deg(2 * np.arccos(cos_half)), max_step)
+
+
+# draw an arc, every step degrees, or with tolerance (in mm) as few evenly spaced points
+# as keep the chords within tolerance of the arc
+def draw_arc(start_angle, end_angle, radius, step=5, tolerance=None):
     # make sure start_angle is less then end_angle
     if start_angle > end_angle:
         start_angle, end_angle = end_angle, start_angle
 
+    if tolerance is not None:
+        count = max(
+            1, int(np.ceil((end_angle - start_angle) / chord_step(radius, tolerance)))
+        )
+        angles = np.deg2rad(np.linspace(start_angle, end_angle, count + 1))
+        return list(zip(radius * np.cos(angles), radius * np.sin(angles)))
+
     points = []
     for angle in np.arange(start_angle, end_angle, step):
         x = radius * np.cos(np.deg2rad(angle))
@@ -27,85 +44,228 @@ def draw_arc(start_angle, end_angle, radius, step=5):
     return points
 
 
-# roate the points by the required angle
-def rotate(points, angle):
-    return [
+# draw an archimedean spiral of turns turns, going out by thickness every turn, with the
+# points placed so the chords stay within tolerance (in mm) of the spiral: the inner
+# turns get more points per degree than the outer ones. The generator notebooks' back
+# layer spiral is flip_y(draw_spiral(..., start_angle=180)).
+def draw_spiral(
+    turns, start_radius, thickness, tolerance=0.01, start_angle=0, max_step=45
+):
+    # number of points needed up to each degree, from the local radius of curvature
+    angles = np.linspace(0, turns * 360, int(np.ceil(turns * 360)) + 1)
+    radius = start_radius + thickness * angles / 360
+    b = thickness / (2 * np.pi)
+    curvature_radius = (radius**2 + b**2) ** 1.5 / (radius**2 + 2 * b**2)
+    # the tangent turns (r^2 + 2 b^2) / (r^2 + b^2) degrees per degree around the centre
+    turning = (radius**2 + 2 * b**2) / (radius**2 + b**2)
+    density = turning / chord_step(curvature_radius, tolerance, max_step)
+    needed = np.concatenate(
+        ([0], np.cumsum((density[1:] + density[:-1]) / 2 * np.diff(angles)))
+    )
+    # spread the points evenly over the number needed
+    count = max(1, int(np.ceil(needed[-1])))
+    angles = np.interp(np.linspace(0, needed[-1], count + 1), needed, angles)
+    radius = start_radius + thickness * angles / 360
+    angles = np.deg2rad(angles + start_angle)
+    return list(zip(radius * np.cos(angles), radius * np.sin(angles)))
+
+
+# the transforms below work on (N, 2) arrays of points as 3x3 affine matrices, so a
+# chain like translate(rotate(flip_y(points), angle), distance, angle) can be fused into
+# one matrix and applied with a single matmul:
+#   transform(
+#       points,
+#       flip_y_matrix(),
+#       rotation_matrix(angle),
+#       translation_matrix(distance, angle),
+#   )
+def rotation_matrix(angle, ox=0, oy=0):
+    c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+    return np.array(
         [
-            x * np.cos(np.deg2rad(angle)) - y * np.sin(np.deg2rad(angle)),
-            x * np.sin(np.deg2rad(angle)) + y * np.cos(np.deg2rad(angle)),
+            [c, -s, ox - c * ox + s * oy],
+            [s, c, oy - s * ox - c * oy],
+            [0, 0, 1],
         ]
-        for x, y in points
-    ]
+    )
+
+
+# move out by distance in the direction of angle
+def translation_matrix(distance, angle):
+    return offset_matrix(
+        distance * np.cos(np.deg2rad(angle)), distance * np.sin(np.deg2rad(angle))
+    )
+
+
+def offset_matrix(dx, dy):
+    return np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]], dtype=float)
+
+
+def scale_matrix(factor):
+    return np.diag([factor, factor, 1.0])
+
+
+def flip_y_matrix():
+    return np.diag([1.0, -1.0, 1.0])
+
+
+def flip_x_matrix():
+    return np.diag([-1.0, 1.0, 1.0])
+
+
+# combine matrices into one, the first one is applied first
+def compose(*matrices):
+    result = np.eye(3)
+    for matrix in matrices:
+        result = matrix @ result
+    return result
+
+
+# apply the matrices (in order) to the points, returns an (N, 2) array
+def transform(points, *matrices):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    matrix = compose(*matrices)
+    return points @ matrix[:2, :2].T + matrix[:2, 2]
+
+
+# apply each of a stack of (M, 3, 3) matrices to the same points, returns an (M, N, 2)
+# array, e.g. every coil of a stator in one go
+def transform_many(points, matrices):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    matrices = np.asarray(matrices, dtype=float)
+    return points @ matrices[:, :2, :2].transpose(0, 2, 1) + matrices[:, None, :2, 2]
+
+
+# lists in give lists out (so tracks can still be joined with +), arrays give arrays
+def _like(points, result):
+    if isinstance(points, np.ndarray):
+        return result
+    return result.tolist()
+
+
+# roate the points by the required angle
+def rotate(points, angle):
+    return _like(points, transform(points, rotation_matrix(angle)))
+
 
 def scale(points, scale):
-    return [[x * scale, y * scale] for x, y in points]
+    return _like(points, transform(points, scale_matrix(scale)))
+
 
 # rotate a point
 def rotate_point(x, y, angle, ox=0, oy=0):
+    c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
     x -= ox
     y -= oy
-    qx = x * np.cos(np.deg2rad(angle)) - y * np.sin(np.deg2rad(angle))
-    qy = x * np.sin(np.deg2rad(angle)) + y * np.cos(np.deg2rad(angle))
-    qx += ox
-    qy += oy
-    return qx, qy
-
+    return x * c - y * s + ox, x * s + y * c + oy
 
 
 # move the points out to the distance at the requited angle
 def translate(points, distance, angle):
-    return [
-        [
-            x + distance * np.cos(np.deg2rad(angle)),
-            y + distance * np.sin(np.deg2rad(angle)),
-        ]
-        for x, y in points
-    ]
+    return _like(points, transform(points, translation_matrix(distance, angle)))
 
 
 # flip the y coordinate
 def flip_y(points):
-    return [[x, -y] for x, y in points]
+    return _like(points, transform(points, flip_y_matrix()))
 
 
 def flip_x(points):
-    return [[-x, y] for x, y in points]
-
-
-def optimize_points(points):
-    # follow the line and remove points that are in the same direction as the previous poin
-    # keep doing this until the direction changes significantly
-    # this is a very simple optimization that removes a lot of points
-    # it's not perfect but it's a good start
-    optimized_points = []
-    for i in range(len(points)):
-        if i == 0:
-            optimized_points.append(points[i])
+    return _like(points, transform(points, flip_x_matrix()))
+
+
+# indices of the points to keep when removing every point where the track turns by less
+# than angle degrees (the last point is compared with the first, the tracks are loops)
+def _angle_indices(points, angle):
+    v1 = points[1:] - points[:-1]
+    v2 = np.roll(points, -1, axis=0)[1:] - points[1:]
+    length1 = np.sqrt(np.sum(v1**2, axis=1))
+    length2 = np.sqrt(np.sum(v2**2, axis=1))
+    turning = (length1 > 0) & (length2 > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dot = np.clip(np.sum(v1 * v2, axis=1) / (length1 * length2), -1, 1)
+    turning &= np.arccos(dot) > np.deg2rad(angle)
+    return np.concatenate(([0], 1 + np.flatnonzero(turning)))
+
+
+# indices of the points to keep so that no removed point is further than tolerance from
+# the simplified track (Ramer-Douglas-Peucker), always keeping the first and last point
+def _tolerance_indices(points, tolerance):
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        inner = points[first + 1 : last]
+        start, direction = points[first], points[last] - points[first]
+        length_sq = np.dot(direction, direction)
+        # distance to the segment, so a loop that returns to its start still works
+        if length_sq > 0:
+            along = np.clip((inner - start) @ direction / length_sq, 0, 1)
         else:
-            vector1 = np.array(points[i]) - np.array(points[i - 1])
-            vector2 = np.array(points[(i + 1) % len(points)]) - np.array(points[i])
-            length1 = np.linalg.norm(vector1)
-            length2 = np.linalg.norm(vector2)
-            if length1 > 0 and length2 > 0:
-                dot = np.dot(vector1, vector2) / (length1 * length2)
-                # clamp dot between -1 and 1
-                dot = max(-1, min(1, dot))
-                angle = np.arccos(dot)
-                if angle > np.deg2rad(5):
-                    optimized_points.append(points[i])
-    print("Optimised from {} to {} points".format(len(points), len(optimized_points)))
-    return optimized_points
-
-
-def chaikin(points, iterations):
+            along = np.zeros(len(inner))
+        offsets = inner - start - along[:, None] * direction
+        distance_sq = np.sum(offsets**2, axis=1)
+        furthest = np.argmax(distance_sq)
+        if distance_sq[furthest] > tolerance**2:
+            middle = first + 1 + furthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return np.flatnonzero(keep)
+
+
+# simplify a track, returns (points, indices of the points that were kept)
+# tolerance=None keeps the points where the track turns by more than angle degrees (what
+# optimize_points has always done); otherwise points are removed as long as the track
+# moves by no more than tolerance (in mm). Keep tolerance a small fraction of the track
+# spacing, e.g. TRACK_SPACING / 4, so neighbouring turns stay clear of each other.
+def simplify_points(points, tolerance=None, angle=5):
+    if len(points) == 0:
+        return points, np.arange(0)
+    array = np.asarray(points, dtype=float).reshape(len(points), -1)
+    if len(array) < 3:
+        indices = np.arange(len(array))
+    elif tolerance is None:
+        indices = _angle_indices(array, angle)
+    else:
+        indices = _tolerance_indices(array, tolerance)
+    return _like(points, array[indices]), indices
+
+
+def optimize_points(points, tolerance=None, angle=5, verbose=False):
+    # follow the line and remove points that are in the same direction as the previous
+    # point, see simplify_points
+    _, indices = simplify_points(points, tolerance, angle)
+    if verbose:
+        print("Optimised from {} to {} points".format(len(points), len(indices)))
+    if isinstance(points, np.ndarray):
+        return points[indices]
+    return [points[i] for i in indices]
+
+
+# smooth a track by cutting its corners: every segment is replaced by the two points
+# weight and 1 - weight of the way along it (weight=0.25 is classic Chaikin). An open
+# track keeps its last point; a closed one also cuts the corner between its last and
+# first point. Each pass doubles the number of points, pass a tolerance (in mm) to
+# simplify_points in between passes.
+def chaikin(points, iterations, weight=0.05, closed=False, tolerance=None):
     if iterations == 0:
         return points
-    l = len(points)
-    smoothed = []
-    for i in range(l - 1):
-        x1, y1 = points[i]
-        x2, y2 = points[i + 1]
-        smoothed.append([0.95 * x1 + 0.05 * x2, 0.95 * y1 + 0.05 * y2])
-        smoothed.append([0.05 * x1 + 0.95 * x2, 0.05 * y1 + 0.95 * y2])
-    smoothed.append(points[l - 1])
-    return chaikin(smoothed, iterations - 1)
+    smoothed = np.asarray(points, dtype=float).reshape(len(points), -1)
+    for i in range(iterations):
+        if closed:
+            starts, ends = smoothed, np.roll(smoothed, -1, axis=0)
+        else:
+            starts, ends = smoothed[:-1], smoothed[1:]
+        cut = np.empty((2 * len(starts) + (not closed), smoothed.shape[1]))
+        cut[0 : 2 * len(starts) : 2] = (1 - weight) * starts + weight * ends
+        cut[1 : 2 * len(starts) : 2] = weight * starts + (1 - weight) * ends
+        if not closed:
+            cut[-1] = smoothed[-1]
+        smoothed = cut
+        if tolerance is not None and i < iterations - 1:
+            smoothed = simplify_points(smoothed, tolerance)[0]
+    return _like(points, smoothed)
@@ -0,0 +1,182 @@
+"""
+Flux linkage and back-EMF of coils over a rotor revolution.
+
+Uses the same motion as rotor_sweep: the coil moves around a circle of the given radius
+centred on (0, -radius), with the magnet at the origin. The flux the magnet puts through
+a coil is the line integral of its vector potential along the track, sum of A . dl over
+the segments, and is evaluated for a whole chunk of angles and every segment of every
+coil in one array operation. The back-EMF follows as -d(flux)/dt at a given speed.
+
+    flux = flux_linkage(coils, DipoleRingMagnet(), poles=8)
+    emf = back_emf(flux, np.arange(360), rpm=3000)
+    write_angle_table("back_emf.csv", np.arange(360), flux, emf, step=5)
+
+Lengths are in m, flux is in Wb, back-EMF in V, angles in degrees, coils in cm.
+"""
+
+import numpy as np
+
+from biot_savart_v4_3 import DEFAULT_MEMORY_BUDGET
+from magnet import CM
+from rotor_sweep import (
+    NOTEBOOK_SWEEP_RADIUS,
+    NOTEBOOK_SWEEP_Z,
+    pack_coils,
+    sum_per_coil,
+    sweep_positions,
+)
+
+# Rough number of bytes of temporaries per (angle, segment) pair of a chunk
+BYTES_PER_FLUX_POINT = 8 * 12
+
+# Default angles of a revolution, one per degree
+FULL_REVOLUTION = np.arange(360)
+
+
+def _flux_chunk(segments, bounds, magnet, positions):
+    """
+    Flux linkage of every coil at a chunk of positions.
+
+    segments, bounds: The coils packed by rotor_sweep.pack_coils
+    positions: (A, 3) positions of the coil origin
+
+    Returns an (A, n_coils) array.
+    """
+    points = segments[None, :, :3] + positions[:, None, :]
+    A = magnet.vector_potential(points.reshape(-1, 3)).reshape(points.shape)
+    per_segment = segments[None, :, 6] * np.sum(A * segments[None, :, 3:6], axis=2)
+    return sum_per_coil(per_segment, bounds)
+
+
+def flux_linkage(
+    coils,
+    magnet,
+    theta=FULL_REVOLUTION,
+    radius=NOTEBOOK_SWEEP_RADIUS,
+    z=NOTEBOOK_SWEEP_Z,
+    scale=CM,
+    poles=1,
+    phases=None,
+    chunk_size=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """
+    Flux of the magnet(s) linked by each coil at every rotor angle.
+
+    coils: Dict of {name: (4, N) coil} (or a list, named 0, 1, ...), already sliced with
+    slice_coil. The currents only give the direction of the track: they are scaled so
+    the largest is 1, so zero-current joins are left out and reversed sections count
+    negatively. A coil without any current raises ValueError.
+    magnet: Magnet model with a vector_potential(points) method, e.g. DipoleRingMagnet
+    theta: Rotor angles, in degrees
+    radius, z: The circle, see rotor_sweep.sweep_positions
+    scale: Size of the coils' length unit in m
+    poles: Number of magnets spread evenly around the rotor with alternating polarity,
+    e.g. 8 for an 8 pole rotor (every angle is evaluated against all of them at once)
+    phases: Optional {phase: [coil names]} to also sum coils wired in series into phases
+    chunk_size: Number of angles per chunk, defaults to what fits memory_budget
+
+    Returns {name: flux} with an array of len(theta) per coil, plus one per phase.
+    """
+    if poles < 1:
+        raise ValueError("poles must be at least 1, got {}".format(poles))
+    coils, segments, bounds = pack_coils(coils, scale, relative_currents=True)
+
+    # every rotor angle against every magnet, pole k sitting 360 k / poles further on
+    theta = np.asarray(theta, dtype=float)
+    shifted = theta[:, None] + 360 * np.arange(poles)[None, :] / poles
+    positions = sweep_positions(shifted.ravel(), radius, z)
+
+    if chunk_size is None:
+        chunk_size = max(
+            1, int(memory_budget) // (BYTES_PER_FLUX_POINT * len(segments))
+        )
+    flux = np.zeros((len(positions), len(coils)))
+    for a in range(0, len(positions), chunk_size):
+        flux[a : a + chunk_size] = _flux_chunk(
+            segments, bounds, magnet, positions[a : a + chunk_size]
+        )
+    polarity = (-1.0) ** np.arange(poles)
+    flux = np.einsum("apc,p->ac", flux.reshape(len(theta), poles, len(coils)), polarity)
+
+    result = {name: flux[:, i] for i, name in enumerate(coils)}
+    for phase, members in (phases or {}).items():
+        result[phase] = np.sum([result[name] for name in members], axis=0)
+    return result
+
+
+def _is_full_revolution(theta):
+    """
+    Whether theta is evenly spaced and wraps around to its start after one more step.
+    """
+    if len(theta) < 3:
+        return False
+    steps = np.diff(theta)
+    return np.allclose(steps, steps[0]) and np.isclose(
+        theta[-1] - theta[0] + steps[0], 360
+    )
+
+
+def back_emf(flux, theta, rpm):
+    """
+    Back-EMF e = -d(flux)/dt of each coil at a constant speed.
+
+    flux: {name: flux} as returned by flux_linkage, or a single array
+    theta: The rotor angles the flux was evaluated at, in degrees
+    rpm: Rotor speed in revolutions per minute
+
+    Uses central differences, wrapping around when theta covers one evenly spaced
+    revolution (as FULL_REVOLUTION does), so the waveform has no end effects.
+
+    Returns the same shape as flux, in V.
+    """
+    if isinstance(flux, dict):
+        return {name: back_emf(values, theta, rpm) for name, values in flux.items()}
+    theta = np.asarray(theta, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    if _is_full_revolution(theta):
+        step = theta[1] - theta[0]
+        dflux = (np.roll(flux, -1) - np.roll(flux, 1)) / (2 * step)
+    else:
+        dflux = np.gradient(flux, theta)
+    # degrees per second
+    return -dflux * rpm * 360 / 60
+
+
+def angle_table(theta, flux, emf=None, step=None):
+    """
+    Packs the curves into one lookup table, one row per angle.
+
+    step: Resample onto angles 0, step, 2 step, ... below 360 (interpolating around the
+    revolution) for a compact table, None keeps theta as it is
+
+    Returns (columns, table) with the column names and an (angles, 1 + curves) array:
+    the angle, the flux of every coil, then the back-EMF of every coil if given.
+    """
+    theta = np.asarray(theta, dtype=float)
+    curves = [("flux_{}".format(name), values) for name, values in flux.items()]
+    if emf is not None:
+        curves += [("emf_{}".format(name), values) for name, values in emf.items()]
+    angles = theta if step is None else np.arange(0, 360, step, dtype=float)
+    table = np.empty((len(angles), 1 + len(curves)))
+    table[:, 0] = angles
+    for i, (_, values) in enumerate(curves, 1):
+        table[:, i] = (
+            values if step is None else np.interp(angles, theta, values, period=360)
+        )
+    return ["angle"] + [name for name, _ in curves], table
+
+
+def write_angle_table(filename, theta, flux, emf=None, step=None):
+    """
+    Writes the lookup table from angle_table to a CSV file with a header row.
+    """
+    columns, table = angle_table(theta, flux, emf, step)
+    np.savetxt(
+        filename,
+        table,
+        fmt="%.6g",
+        delimiter=",",
+        header=",".join(columns),
+        comments="",
+    )
@@ -0,0 +1,236 @@
+"""
+Optional accelerated backends for the straight-segment Biot-Savart kernel.
+
+Every backend follows the contract of biot_savart_v4_3._straight_segment_block (see
+KERNEL_BACKENDS) and registers itself when the package it needs can be imported:
+    "numba" - a JIT-compiled loop over points and segments, parallel over the points
+    "numexpr" - the NumPy expressions evaluated by numexpr, without the big temporaries
+
+calculate_field(..., backend="fastest") runs on whichever is quickest on this machine.
+Run this file to check every available backend against the NumPy reference on the coils
+in coils/:
+
+    python backends.py
+
+All lengths are in cm, B-field is in G
+"""
+
+import glob
+import itertools
+import os
+import sys
+
+import numpy as np
+
+import biot_savart_v4_3 as bs
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# Largest deviation from the NumPy backend check_backends accepts, relative to the
+# largest field, per dtype
+BACKEND_TOLERANCE = {np.dtype(np.float64): 1e-9, np.dtype(np.float32): 1e-4}
+
+
+def _collinear_tolerance(dtype):
+    """
+    Same collinear threshold as the NumPy kernel uses.
+    """
+    return max(bs.COLLINEAR_TOLERANCE, 10 * np.finfo(dtype).eps)
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_kernel(start, end, current, points, wire_radius, tolerance):
+        B = np.zeros((points.shape[0], 3), dtype=points.dtype)
+        for p in numba.prange(points.shape[0]):
+            Bx = By = Bz = 0.0
+            for k in range(start.shape[0]):
+                ax = start[k, 0] - points[p, 0]
+                ay = start[k, 1] - points[p, 1]
+                az = start[k, 2] - points[p, 2]
+                bx = end[k, 0] - points[p, 0]
+                by = end[k, 1] - points[p, 1]
+                bz = end[k, 2] - points[p, 2]
+                cx = ay * bz - az * by
+                cy = az * bx - ax * bz
+                cz = ax * by - ay * bx
+                cross_sq = cx * cx + cy * cy + cz * cz
+                la = np.sqrt(ax * ax + ay * ay + az * az)
+                lb = np.sqrt(bx * bx + by * by + bz * bz)
+                lalb = la * lb
+                # points on the wire or in line with it get no field from this segment
+                if cross_sq <= (tolerance * lalb) ** 2:
+                    continue
+                scale = (
+                    current[k]
+                    * (la + lb)
+                    / (lalb * (lalb + ax * bx + ay * by + az * bz))
+                )
+                if wire_radius > 0:
+                    dx = end[k, 0] - start[k, 0]
+                    dy = end[k, 1] - start[k, 1]
+                    dz = end[k, 2] - start[k, 2]
+                    dl_sq = dx * dx + dy * dy + dz * dz
+                    rho_sq = cross_sq / dl_sq
+                    along = -(ax * dx + ay * dy + az * dz) / dl_sq
+                    if rho_sq < wire_radius**2 and along >= 0 and along <= 1:
+                        scale *= rho_sq / wire_radius**2
+                Bx += cx * scale
+                By += cy * scale
+                Bz += cz * scale
+            B[p, 0] = Bx
+            B[p, 1] = By
+            B[p, 2] = Bz
+        return B
+
+    def numba_segment_block(start, end, current, points, wire_radius=0):
+        """
+        The straight-segment kernel as a compiled loop, see _straight_segment_block.
+        """
+        dtype = points.dtype
+        return _numba_kernel(
+            np.ascontiguousarray(start, dtype=dtype),
+            np.ascontiguousarray(end, dtype=dtype),
+            np.ascontiguousarray(current, dtype=dtype),
+            np.ascontiguousarray(points),
+            dtype.type(wire_radius),
+            dtype.type(_collinear_tolerance(dtype)),
+        )
+
+    bs.register_backend("numba", numba_segment_block)
+
+
+if numexpr is not None:
+
+    def numexpr_segment_block(start, end, current, points, wire_radius=0):
+        """
+        The straight-segment kernel evaluated with numexpr, see _straight_segment_block.
+        """
+        dtype = points.dtype
+        # vectors from the points to the segment ends, laid out as (points, segments)
+        a = [start[None, :, i] - points[:, i, None] for i in range(3)]
+        b = [end[None, :, i] - points[:, i, None] for i in range(3)]
+        terms = dict(ax=a[0], ay=a[1], az=a[2], bx=b[0], by=b[1], bz=b[2])
+        terms["cx"] = numexpr.evaluate("ay * bz - az * by", terms)
+        terms["cy"] = numexpr.evaluate("az * bx - ax * bz", terms)
+        terms["cz"] = numexpr.evaluate("ax * by - ay * bx", terms)
+        terms["current"] = current[None, :].astype(dtype, copy=False)
+        terms["tolerance"] = dtype.type(_collinear_tolerance(dtype))
+        terms["lalb"] = numexpr.evaluate(
+            "sqrt(ax**2 + ay**2 + az**2) * sqrt(bx**2 + by**2 + bz**2)", terms
+        )
+        terms["scale"] = numexpr.evaluate(
+            "where(cx**2 + cy**2 + cz**2 <= (tolerance * lalb)**2, 0,"
+            " current * (sqrt(ax**2 + ay**2 + az**2) + sqrt(bx**2 + by**2 + bz**2))"
+            " / (lalb * (lalb + ax * bx + ay * by + az * bz)))",
+            terms,
+        )
+
+        if wire_radius > 0:
+            dl = (end - start).astype(dtype, copy=False)
+            terms.update(
+                dx=dl[None, :, 0],
+                dy=dl[None, :, 1],
+                dz=dl[None, :, 2],
+                radius_sq=dtype.type(wire_radius**2),
+            )
+            terms["scale"] = numexpr.evaluate(
+                "where(((dx**2 + dy**2 + dz**2) * radius_sq > cx**2 + cy**2 + cz**2)"
+                " & (-(ax * dx + ay * dy + az * dz) >= 0)"
+                " & (-(ax * dx + ay * dy + az * dz) <= dx**2 + dy**2 + dz**2),"
+                " scale * (cx**2 + cy**2 + cz**2)"
+                " / ((dx**2 + dy**2 + dz**2) * radius_sq), scale)",
+                terms,
+            )
+
+        return np.column_stack(
+            [
+                numexpr.evaluate("sum({} * scale, axis=1)".format(c), terms)
+                for c in ("cx", "cy", "cz")
+            ]
+        ).astype(dtype, copy=False)
+
+    bs.register_backend("numexpr", numexpr_segment_block)
+
+
+def check_backends(
+    filenames=None, n_points=500, dtypes=(np.float64, np.float32), seed=0
+):
+    """
+    Compares every available backend with the NumPy backend on the bundled coils, for
+    the "segment" (with and without a wire radius) and "tree" methods, in each dtype.
+
+    filenames: Coil CSV files to check on, defaults to every file in coils/
+    n_points: Number of random points in and around the bounding box of each coil
+
+    Returns a list of
+    (backend, method, filename, dtype, wire_radius, relative_error, ok) tuples.
+    """
+    if filenames is None:
+        filenames = sorted(
+            glob.glob(
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)), "coils", "*.csv"
+                )
+            )
+        )
+    rng = np.random.default_rng(seed)
+    results = []
+    for filename in filenames:
+        coil = bs.parse_coil(filename)
+        low, high = coil[:3].min(axis=1) - 0.5, coil[:3].max(axis=1) + 0.5
+        points = rng.uniform(low, high, (n_points, 3))
+        # also land exactly on vertices, where the kernel has to handle the singularity
+        on_coil = min(50, coil.shape[1], n_points)
+        points[:on_coil] = coil[:3, :on_coil].T
+        cases = itertools.chain(
+            itertools.product(("segment",), dtypes, (0, 0.01)),
+            itertools.product(("tree",), dtypes, (0,)),
+        )
+        for method, dtype, wire_radius in cases:
+            dtype = np.dtype(dtype)
+            options = dict(method=method, dtype=dtype, wire_radius=wire_radius)
+            reference = bs.produce_target_points(coil, points, **options)
+            peak = np.max(np.sqrt(np.sum(reference.astype(float) ** 2, axis=1)))
+            for name in bs.available_backends():
+                result = bs.produce_target_points(coil, points, backend=name, **options)
+                error = float(np.max(np.abs(result - reference)) / peak)
+                results.append(
+                    (
+                        name,
+                        method,
+                        os.path.basename(filename),
+                        dtype.name,
+                        wire_radius,
+                        error,
+                        error <= BACKEND_TOLERANCE[dtype],
+                    )
+                )
+    return results
+
+
+if __name__ == "__main__":
+    results = check_backends()
+    for name, method, filename, dtype, wire_radius, error, ok in results:
+        print(
+            "{:<8} {:<8} {:<28} {:<8} r={:<5} {:10.2e} {}".format(
+                name,
+                method,
+                filename,
+                dtype,
+                wire_radius,
+                error,
+                "ok" if ok else "FAILED",
+            )
+        )
+    print("fastest backend:", bs.fastest_backend())
+    sys.exit(0 if all(result[-1] for result in results) else 1)
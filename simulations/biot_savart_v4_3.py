@@ -8,23 +8,142 @@ All lengths are in cm, B-field is in G
 from - https://github.com/vuthalab/biot-savart
 """
 
+import ast
+import functools
+import hashlib
+import json
+import multiprocessing
+import operator
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.cm as cm
 import matplotlib.ticker as ticker
 
+import coil_geometry
+import instrumentation
+from instrumentation import timed
+
 """
 Feature Wishlist:
     improve plot_coil with different colors for different values of current
+"""
 
-    accelerate integrator to use meshgrids directly instead of a layer of for loop
 
-    get parse_coil to use vectorized function instead of for loop
-"""
+# How the worker processes of produce_target_volume and rotor_sweep are started. Not
+# "fork": a forked copy of a process that has run numba's parallel kernel can hang.
+POOL_START_METHOD = "spawn"
+
+# Suffix of the binary sidecar parse_coil writes next to each CSV file it reads
+COIL_CACHE_SUFFIX = ".cache.npz"
 
+# Arithmetic allowed in coil CSV cells, the generator notebooks write z as
+# 0-(0.011+0.04) for example
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
 
-def parse_coil(filename):
+
+def evaluate_expression(text):
+    """
+    Evaluates a plain arithmetic expression such as "0-(0.011+0.04)" without eval().
+
+    Only numbers, + - * / and brackets are allowed, anything else raises a ValueError.
+    """
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if (
+            isinstance(node, ast.Constant)
+            and isinstance(node.value, (int, float))
+            and not isinstance(node.value, bool)
+        ):
+            return float(node.value)
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            return _BINARY_OPERATORS[type(node.op)](
+                evaluate(node.left), evaluate(node.right)
+            )
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            return _UNARY_OPERATORS[type(node.op)](evaluate(node.operand))
+        raise ValueError("unsupported expression in coil file: {!r}".format(text))
+
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError:
+        raise ValueError("could not parse coil file value: {!r}".format(text))
+    try:
+        return evaluate(tree)
+    except (OverflowError, ZeroDivisionError):
+        raise ValueError("could not evaluate coil file value: {!r}".format(text))
+
+
+def _parse_column(cells):
+    """
+    Converts a column of CSV cell strings to floats.
+
+    Plain numbers are converted by NumPy in one go. If some cells hold expressions, each
+    distinct cell is only looked at once (a layer's z expression repeats on every line)
+    and only the ones that are not plain numbers are evaluated as expressions.
+    """
+    try:
+        return cells.astype(float)
+    except ValueError:
+        pass
+
+    values, inverse = np.unique(cells, return_inverse=True)
+    parsed = np.empty(len(values))
+    for i, value in enumerate(values):
+        try:
+            parsed[i] = float(value)
+        except ValueError:
+            parsed[i] = evaluate_expression(value)
+    return parsed[inverse].reshape(cells.shape)
+
+
+def _parse_cells(cells):
+    """
+    Converts a (lines, columns) array of CSV cell strings to floats, column by column,
+    so expressions in one column (the layer heights) leave the others on the fast path.
+    """
+    parsed = np.empty(cells.shape)
+    for column in range(cells.shape[1]):
+        parsed[:, column] = _parse_column(cells[:, column])
+    return parsed
+
+
+def parse_coil_text(text):
+    """
+    Parses the contents of a coil CSV file into x,y,z,I slices (see parse_coil).
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError("coil file is empty")
+    columns = lines[0].count(",") + 1
+    cells = np.array(",".join(lines).split(","))
+    if cells.size != len(lines) * columns:
+        raise ValueError(
+            "every line of a coil file must have the same number of columns"
+        )
+
+    return _parse_cells(cells.reshape(len(lines), columns)).T
+
+
+@timed("parse")
+def parse_coil(filename, cache=True):
     """
     Parses 4 column CSV into x,y,z,I slices for coil.
 
@@ -36,48 +155,109 @@ def parse_coil(filename):
     - There are 2 amps of current running between points 1 and 2
     - There are 3 amps of current running between points 2 and 3
     - The last bit of current is functionally useless.
+
+    Cells can be plain numbers or simple arithmetic expressions like 0-(0.011+0.04).
+
+    cache: Keep a binary copy of the parsed coil next to the CSV (filename +
+    COIL_CACHE_SUFFIX). It is reused while the CSV has the same size and modification
+    time, or the same content hash, so re-opening a coil costs almost nothing.
     """
-    with open(filename, "r") as f:
-        return np.array(
-            [[eval(i) for i in line.split(",")] for line in f.read().splitlines()]
-        ).T
+    if not cache:
+        with open(filename, "r") as f:
+            return parse_coil_text(f.read())
+
+    cache_filename = str(filename) + COIL_CACHE_SUFFIX
+    stat = os.stat(filename)
+    cached = _read_coil_cache(cache_filename)
+    if (
+        cached is not None
+        and cached["size"] == stat.st_size
+        and cached["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return cached["coil"]
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if cached is not None and cached["sha256"] == digest:
+        coil = cached["coil"]
+    else:
+        coil = parse_coil_text(data.decode())
+    _write_coil_cache(cache_filename, coil, stat, digest)
+    return coil
 
 
-def slice_coil(coil, steplength):
+def _read_coil_cache(cache_filename):
     """
-    Slices a coil into pieces of size steplength.
+    Loads a parse_coil cache file, returns None if it is missing or unreadable.
+    """
+    try:
+        with np.load(cache_filename, allow_pickle=False) as cached:
+            return {
+                "coil": cached["coil"],
+                "size": int(cached["size"]),
+                "mtime_ns": int(cached["mtime_ns"]),
+                "sha256": str(cached["sha256"]),
+            }
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def _write_coil_cache(cache_filename, coil, stat, digest):
+    """
+    Writes a parse_coil cache file. Failing to write the cache (e.g. a read-only
+    directory) is not an error, the coil just gets parsed again next time.
+    """
+    temp_filename = cache_filename + ".tmp"
+    try:
+        with open(temp_filename, "wb") as f:
+            np.savez(
+                f,
+                coil=coil,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                sha256=digest,
+            )
+        os.replace(temp_filename, cache_filename)
+    except OSError:
+        pass
 
-    If the coil is already sliced into pieces smaller than that, this does nothing.
+
+def write_coil(filename, coil):
     """
+    Writes a (4, N) coil array to filename in the 4 column CSV format parse_coil reads,
+    in a single write. Values are written as the shortest text that reads back exactly.
+    """
+    rows = np.asarray(coil, dtype=float).T.tolist()
+    with open(filename, "w") as f:
+        f.write("".join(",".join(map(repr, row)) + "\n" for row in rows))
 
-    def interpolate_points(p1, p2, parts):
-        """
-        Produces a series of linearly spaced points between two given points in R3+I
 
-        Linearly interpolates X,Y,Z; but keeps I the SAME
+@timed("slice")
+def slice_coil(coil, steplength, dtype=np.float64):
+    """
+    Slices a coil into pieces of size steplength.
 
-        i.e. (0, 2, 1, 3), (3, 4, 2, 5), parts = 2:
-        (0, 2, 1, 3), (1.5, 3, 1.5, 3), (3, 4, 2, 5)
-        """
-        return np.column_stack(
-            (
-                np.linspace(p1[0], p2[0], parts + 1),
-                np.linspace(p1[1], p2[1], parts + 1),
-                np.linspace(p1[2], p2[2], parts + 1),
-                p1[3] * np.ones((parts + 1)),
-            )
-        )
+    If the coil is already sliced into pieces smaller than that, this does nothing.
 
-    newcoil = np.zeros(
-        (1, 4)
-    )  # fill column with dummy data, we will remove this later.
+    steplength: Maximum length of the pieces, either one value for the whole coil or an
+    array with one value per segment (len = number of vertices - 1) to slice
+    non-uniformly.
 
+    Each segment is linearly interpolated on X,Y,Z while keeping the current of its
+    start vertex, i.e. (0, 2, 1, 3), (3, 4, 2, 5) in 2 parts gives:
+    (0, 2, 1, 3), (1.5, 3, 1.5, 3), (3, 4, 2, 3)
+
+    dtype: Precision of the returned coil, np.float32 halves its size (the interpolation
+    itself is always done in float64)
+    """
+    coil = np.asarray(coil, dtype=float)
     segment_starts = coil[:, :-1]
     segment_ends = coil[:, 1:]
     # determine start and end of each segment
 
     segments = segment_ends - segment_starts
-    segment_lengths = np.apply_along_axis(np.linalg.norm, 0, segments)
+    segment_lengths = np.sqrt(np.sum(segments[:3] ** 2, axis=0))
     # create segments; determine start and end of each segment, as well as segment lengths
 
     # chop up into smaller bits (elements)
@@ -85,77 +265,470 @@ def slice_coil(coil, steplength):
     stepnumbers = (segment_lengths / steplength).astype(int)
     # determine how many steps we must chop each segment into
 
-    for i in range(segments.shape[1]):
-        newrows = interpolate_points(
-            segment_starts[:, i], segment_ends[:, i], stepnumbers[i]
+    # each segment contributes its start, the interpolated points and its end point
+    counts = stepnumbers + 1
+    total = int(np.sum(counts))
+    segment_index = np.repeat(np.arange(len(counts)), counts)
+    step_index = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    parts = np.maximum(stepnumbers, 1)[segment_index]
+    # one extra row when needed so the coil has an even number of segments
+    newcoil = np.empty((total + (total + 1) % 2, 4))
+    for axis in range(3):
+        step = segments[axis, segment_index] / parts
+        newcoil[:total, axis] = segment_starts[axis, segment_index] + step_index * step
+    newcoil[:total, 3] = segment_starts[3, segment_index]
+
+    # land exactly on the segment ends, like np.linspace does
+    at_end = (step_index == stepnumbers[segment_index]) & (step_index > 0)
+    newcoil[:total, :3][at_end] = segment_ends[:3, segment_index[at_end]].T
+
+    if newcoil.shape[0] != total:
+        newcoil[-1, :] = newcoil[total - 1, :]
+    ## Force the coil to have an even number of segments, for Richardson Extrapolation to work
+
+    return newcoil.T.astype(dtype, copy=False)
+
+
+# Rough number of bytes of temporaries needed per (segment, point) pair in the
+# field kernel; used to turn a memory budget into block sizes.
+BYTES_PER_PAIR = 8 * 24
+
+# Default amount of scratch memory calculate_field may use per block (in bytes)
+DEFAULT_MEMORY_BUDGET = 8 * 1024**2
+
+# Size of the slabs write_target_volume streams to disk at a time (in bytes)
+SLAB_BYTES = 64 * 1024**2
+
+# Suffix of the JSON file describing the box of a saved target volume
+VOLUME_METADATA_SUFFIX = ".json"
+
+# Smallest block of target points we aim for when splitting up the segments
+MIN_POINT_BLOCK = 256
+
+# Integration methods understood by calculate_field
+FIELD_METHODS = ("richardson", "segment", "tree")
+
+# Default accuracy and cluster size of the tree code, see treecode.py
+DEFAULT_THETA = 0.4
+DEFAULT_LEAF_SIZE = 64
+
+# Backend calculate_field runs the straight-segment kernel on, see register_backend
+DEFAULT_BACKEND = "numpy"
+
+# Points whose distance to a segment's line is below this fraction of their distance
+# to its ends are treated as lying on the line
+COLLINEAR_TOLERANCE = 1e-12
+
+
+def block_sizes(n_segments, n_points, memory_budget=DEFAULT_MEMORY_BUDGET, itemsize=8):
+    """
+    Chooses how many segments and how many target points to process together so that
+    the temporaries of one block stay within memory_budget bytes.
+
+    itemsize: Bytes per number, 8 for float64 and 4 for float32
+
+    The segment block size only depends on the number of segments and the budget, never
+    on the number of points. That way every point sees the segments summed in the same
+    order no matter how the points are split up, and tiled evaluations give exactly the
+    same answer as evaluating everything at once.
+    """
+    pair_budget = max(1, int(memory_budget) // (BYTES_PER_PAIR * itemsize // 8))
+    segment_block = int(np.clip(pair_budget // MIN_POINT_BLOCK, 1, max(n_segments, 1)))
+    point_block = int(np.clip(pair_budget // segment_block, 1, max(n_points, 1)))
+    return segment_block, point_block
+
+
+def flatten_points(x, y, z):
+    """
+    Broadcasts x, y, z against each other and flattens them into (P, 3) points.
+
+    The points are taken in the transposed order of the input arrays, so reshaping a
+    per-point result to the returned shape gives the same layout calculate_field has
+    always produced: a meshgrid of shape (nz, ny, nx) from produce_target_volume becomes
+    a field indexed as [x, y, z, component].
+    """
+    x, y, z = np.broadcast_arrays(x, y, z)
+    shape = x.T.shape
+    points = np.column_stack((x.T.ravel(), y.T.ravel(), z.T.ravel())).astype(float)
+    return points, shape
+
+
+def _midpoint_block(start, end, current, points):
+    """
+    Produces the tiny segments of magnetic field vector (dB) of a block of segments at a
+    block of points using the midpoint approximation.
+
+    start, end: (K, 3) segment end points
+    current: (K,) current flowing through each segment
+    points: (P, 3) evaluation points
+
+    Returns a (3, P, K) array of contributions (without the mu_0 / 4pi factor). Keeping
+    the segments on the last axis means the sum over them is always a contiguous
+    reduction, which makes the result independent of how many points are in the block.
+    """
+    dl = end - start
+    mid = (start + end) / 2
+    # relative position vectors, laid out as (points, segments)
+    rx = points[:, 0, None] - mid[None, :, 0]
+    ry = points[:, 1, None] - mid[None, :, 1]
+    rz = points[:, 2, None] - mid[None, :, 2]
+    # magnitude of the relative position vector
+    scale = current / np.sqrt(rx**2 + ry**2 + rz**2) ** 3
+
+    # Apply the Biot-Savart Law to get the differential magnetic field
+    dB = np.empty((3,) + rx.shape, dtype=rx.dtype)
+    dB[0] = (dl[:, 1] * rz - dl[:, 2] * ry) * scale
+    dB[1] = (dl[:, 2] * rx - dl[:, 0] * rz) * scale
+    dB[2] = (dl[:, 0] * ry - dl[:, 1] * rx) * scale
+    return dB
+
+
+def _richardson_block(starts, mids, ends, points):
+    """
+    Midpoint integration with 1 layer of Richardson Extrapolation over a block of
+    segment pairs (start -> mid -> end), summed over the segments.
+
+    starts, mids, ends: (K, 4) coil vertices (x, y, z, I)
+    points: (P, 3) evaluation points
+
+    Returns a (P, 3) array.
+    """
+    fullpart = _midpoint_block(starts[:, :3], ends[:, :3], starts[:, 3], points)
+    # stage 1 richardson
+    halfpart = _midpoint_block(
+        starts[:, :3], mids[:, :3], starts[:, 3], points
+    ) + _midpoint_block(mids[:, :3], ends[:, :3], mids[:, 3], points)
+    # stage 2 richardson
+
+    # richardson extrapolated midpoint rule
+    return np.sum(4 / 3 * halfpart - 1 / 3 * fullpart, axis=2).T
+
+
+def _straight_segment_block(start, end, current, points, wire_radius=0):
+    """
+    Exact magnetic field of a block of finite straight current segments at a block of
+    points, summed over the segments.
+
+    start, end: (K, 3) segment end points
+    current: (K,) current flowing through each segment
+    points: (P, 3) evaluation points
+    wire_radius: Radius of the conductor. Points closer than this to a segment (and
+    alongside it) see the field inside a solid round wire, which falls linearly to zero
+    on its axis. With wire_radius = 0 points on a wire get no field from that segment.
+
+    Uses B = I (a x b) (|a| + |b|) / (|a| |b| (|a| |b| + a.b)) with a, b the vectors
+    from the point to the segment's start and end. Returns a (P, 3) array (without
+    mu_0 / 4pi).
+    """
+    # vectors from the points to the segment ends, laid out as (points, segments)
+    ax = start[None, :, 0] - points[:, 0, None]
+    ay = start[None, :, 1] - points[:, 1, None]
+    az = start[None, :, 2] - points[:, 2, None]
+    bx = end[None, :, 0] - points[:, 0, None]
+    by = end[None, :, 1] - points[:, 1, None]
+    bz = end[None, :, 2] - points[:, 2, None]
+
+    cx = ay * bz - az * by
+    cy = az * bx - ax * bz
+    cz = ax * by - ay * bx
+    cross_sq = cx**2 + cy**2 + cz**2
+    la = np.sqrt(ax**2 + ay**2 + az**2)
+    lb = np.sqrt(bx**2 + by**2 + bz**2)
+    lalb = la * lb
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = current * (la + lb) / (lalb * (lalb + ax * bx + ay * by + az * bz))
+    # points on the wire or in line with it, the field is zero on a straight wire's axis
+    tolerance = max(COLLINEAR_TOLERANCE, 10 * np.finfo(scale.dtype).eps)
+    scale[cross_sq <= (tolerance * lalb) ** 2] = 0
+
+    if wire_radius > 0:
+        dl = end - start
+        dl_sq = np.sum(dl**2, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rho_sq = cross_sq / dl_sq
+            along = -(ax * dl[:, 0] + ay * dl[:, 1] + az * dl[:, 2]) / dl_sq
+        inside = (rho_sq < wire_radius**2) & (along >= 0) & (along <= 1)
+        scale[inside] *= rho_sq[inside] / wire_radius**2
+
+    dB = np.stack((cx * scale, cy * scale, cz * scale))
+    return np.sum(dB, axis=2).T
+
+
+def _sum_over_blocks(kernel, segments, points, memory_budget):
+    """
+    Adds up kernel(*segment_block, point_block) over blocks of segments and points.
+
+    segments: tuple of arrays with one row per segment, sliced together into blocks
+    points: (P, 3) evaluation points
+
+    Reports its progress as the "integrate" stage, in segment * point pairs.
+    """
+    B = np.zeros((len(points), 3), dtype=points.dtype)
+    n_segments = len(segments[0])
+    segment_block, point_block = block_sizes(
+        n_segments, len(points), memory_budget, points.dtype.itemsize
+    )
+    inst = instrumentation.active()
+    inst.count(
+        "bytes_allocated",
+        B.nbytes
+        + segment_block
+        * min(point_block, len(points))
+        * BYTES_PER_PAIR
+        * points.dtype.itemsize
+        // 8,
+    )
+    total = n_segments * len(points)
+    inst.progress("integrate", 0, total)
+    for p in range(0, len(points), point_block):
+        target = points[p : p + point_block]
+        for s in range(0, n_segments, segment_block):
+            block = tuple(segment[s : s + segment_block] for segment in segments)
+            B[p : p + point_block] += kernel(*block, target)
+        inst.progress(
+            "integrate", min(p + point_block, len(points)) * n_segments, total
         )
-        # set of new interpolated points to feed in
-        newcoil = np.vstack((newcoil, newrows))
+    return B
 
-    if newcoil.shape[0] % 2 != 0:
-        newcoil = np.vstack((newcoil, newcoil[-1, :]))
-    ## Force the coil to have an even number of segments, for Richardson Extrapolation to work
 
-    return newcoil[1:, :].T  # return non-dummy columns
+# Straight-segment kernels by name, all following the contract of
+# _straight_segment_block: kernel(start, end, current, points, wire_radius=0) -> (P, 3)
+# field without mu_0 / 4pi, in the dtype of points. Optional backends are added by
+# backends.py when importable.
+KERNEL_BACKENDS = {"numpy": _straight_segment_block}
+
+# name of the fastest backend per dtype, filled in by fastest_backend
+_fastest_backends = {}
+
+
+def register_backend(name, kernel):
+    """
+    Adds (or replaces) a straight-segment kernel calculate_field can run on with
+    backend=name. See KERNEL_BACKENDS for the contract the kernel has to follow.
+    """
+    KERNEL_BACKENDS[name] = kernel
+    _fastest_backends.clear()
+
+
+def available_backends():
+    """
+    Returns the names of every registered backend, after loading the optional ones.
+    """
+    import backends  # registers whatever accelerated backends can be imported
+
+    return list(KERNEL_BACKENDS)
+
 
+def get_backend(name, dtype=np.float64):
+    """
+    Returns the kernel of a backend, "fastest" picks one with fastest_backend for dtype
+    (the dtype the kernel will run in).
+    """
+    if name == "fastest":
+        name = fastest_backend(dtype)
+    if name not in KERNEL_BACKENDS and name not in available_backends():
+        raise ValueError(
+            "unknown backend {!r}, expected one of {}".format(
+                name, available_backends()
+            )
+        )
+    return KERNEL_BACKENDS[name]
+
+
+def fastest_backend(
+    dtype=np.float64,
+    n_segments=512,
+    n_points=4096,
+    repeat=3,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """
+    Times every available backend on one random block of the shape _sum_over_blocks
+    would cut n_segments segments and n_points points into for memory_budget, and
+    returns the name of the fastest. The choice is remembered per dtype.
+    """
+    dtype = np.dtype(dtype)
+    if dtype in _fastest_backends:
+        return _fastest_backends[dtype]
 
-def calculate_field(coil, x, y, z):
+    n_segments, n_points = block_sizes(
+        n_segments, n_points, memory_budget, dtype.itemsize
+    )
+    rng = np.random.default_rng(0)
+    vertices = rng.uniform(-1, 1, (n_segments + 1, 3)).astype(dtype)
+    current = np.ones(n_segments, dtype=dtype)
+    points = rng.uniform(-2, 2, (n_points, 3)).astype(dtype)
+    timings = {}
+    for name in available_backends():
+        kernel = KERNEL_BACKENDS[name]
+        # the first call may compile, only time the ones after it
+        kernel(vertices[:-1], vertices[1:], current, points)
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            kernel(vertices[:-1], vertices[1:], current, points)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+    _fastest_backends[dtype] = min(timings, key=timings.get)
+    return _fastest_backends[dtype]
+
+
+@timed("integrate")
+def calculate_field(
+    coil,
+    x,
+    y,
+    z,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    method="richardson",
+    wire_radius=0,
+    theta=DEFAULT_THETA,
+    leaf_size=DEFAULT_LEAF_SIZE,
+    dtype=np.float64,
+    backend=DEFAULT_BACKEND,
+):
     """
     Calculates magnetic field vector as a result of some position and current x, y, z, I
     [In the same coordinate system as the coil]
 
-    Coil: Input Coil Positions, already sub-divided into small pieces using slice_coil
+    Coil: Input Coil Positions
     x, y, z: position in cm
+    memory_budget: Approximate number of bytes of scratch memory to use at once. The
+    coil segments and the target points are processed in blocks sized to fit it.
+    method: How to integrate along the coil
+        "richardson" - midpoint rule with 1 layer of Richardson Extrapolation, the coil
+        must already be sub-divided into small pieces using slice_coil
+        "segment" - exact field of each straight segment between the coil vertices,
+        works on the raw parse_coil output without slicing
+        "tree" - the "segment" sum approximated with a Barnes-Hut tree code, for large
+        coils and grids (see treecode.py and treecode.tree_error to check its accuracy)
+    wire_radius: Only used by the "segment" method, see _straight_segment_block (in cm)
+    theta, leaf_size: Accuracy parameter and cluster size of the "tree" method
+    dtype: np.float64 or np.float32 to halve the memory and bandwidth of the kernel (the
+    "tree" method always works in float64 and only returns dtype). See precision_error.
+    backend: Kernel the "segment" and "tree" methods run on, one of available_backends()
+    or "fastest" (see fastest_backend). "richardson" always uses NumPy.
 
     Output B-field is a 3-D vector in units of G
     """
     FACTOR = 0.1  # = mu_0 / 4pi when lengths are in cm, and B-field is in G
 
-    def bs_integrate(start, end):
-        """
-        Produces tiny segment of magnetic field vector (dB) using the midpoint approximation over some interval
-
-        TODO for future optimization: Get this to work with meshgrids directly
-        """
-        dl = (end - start).T
-        mid = (start + end) / 2
-        position = np.array((x - mid[0], y - mid[1], z - mid[2])).T
-        # relative position vector
-        mag = np.sqrt((x - mid[0]) ** 2 + (y - mid[1]) ** 2 + (z - mid[2]) ** 2)
-        # magnitude of the relative position vector
-
-        return (
-            start[3]
-            * np.cross(dl[:3], position)
-            / np.array((mag**3, mag**3, mag**3)).T
+    dtype = np.dtype(dtype)
+    work_dtype = np.dtype(np.float64) if method == "tree" else dtype
+    points, shape = flatten_points(x, y, z)
+    coil = np.array(coil, dtype=float)
+
+    # work relative to the middle of the coil so float32 keeps its precision
+    origin = (coil[:3].min(axis=1) + coil[:3].max(axis=1)) / 2
+    points = (points - origin).astype(work_dtype)
+    coil[:3] -= origin[:, None]
+    coil = coil.astype(work_dtype)
+
+    inst = instrumentation.active()
+    inst.count("segments", coil.shape[1] - 1)
+    inst.count("points", len(points))
+
+    if method == "richardson":
+        starts, mids, ends = coil[:, :-1:2].T, coil[:, 1::2].T, coil[:, 2::2].T
+        if not (len(starts) == len(mids) == len(ends)):
+            raise ValueError(
+                "coil must have an even number of segments, "
+                "use slice_coil to prepare it"
+            )
+        B = _sum_over_blocks(
+            _richardson_block, (starts, mids, ends), points, memory_budget
         )
-        # Apply the Biot-Savart Law to get the differential magnetic field
-        # current flowing in this segment is represented by start[3]
+    elif method == "segment":
+        B = _sum_over_blocks(
+            functools.partial(
+                get_backend(backend, work_dtype), wire_radius=wire_radius
+            ),
+            (coil[:3, :-1].T, coil[:3, 1:].T, coil[3, :-1]),
+            points,
+            memory_budget,
+        )
+    elif method == "tree":
+        from treecode import build_tree, tree_field
 
-    B = 0
+        tree = build_tree(coil[:3, :-1].T, coil[:3, 1:].T, coil[3, :-1], leaf_size)
+        B = tree_field(
+            tree, points, theta, memory_budget, get_backend(backend, work_dtype)
+        )
+    else:
+        raise ValueError(
+            "unknown method {!r}, expected one of {}".format(method, FIELD_METHODS)
+        )
 
-    # midpoint integration with 1 layer of Richardson Extrapolation
-    starts, mids, ends = coil[:, :-1:2], coil[:, 1::2], coil[:, 2::2]
+    # return SUM of all components as 3 (x,y,z) meshgrids for (Bx, By, Bz) component
+    # when evaluated using produce_target_volume
+    return (B * FACTOR).astype(dtype, copy=False).reshape(shape + (3,))
 
-    for start, mid, end in np.nditer(
-        [starts, mids, ends], flags=["external_loop"], order="F"
-    ):
-        # use numpy fast indexing
-        fullpart = bs_integrate(start, end)  # stage 1 richardson
-        halfpart = bs_integrate(start, mid) + bs_integrate(
-            mid, end
-        )  # stage 2 richardson
 
-        B += (
-            4 / 3 * halfpart - 1 / 3 * fullpart
-        )  # richardson extrapolated midpoint rule
+def precision_error(
+    coil, x, y, z, dtype=np.float32, samples=None, seed=0, **field_options
+):
+    """
+    Measures how far calculate_field in a lower precision dtype deviates from float64.
+
+    samples: Only compare on this many randomly chosen points of x, y, z (None for all)
+    field_options: Extra keyword arguments passed on to calculate_field
+
+    Returns a dict with:
+        points - number of points compared
+        max_error - largest deviation of the field vector (G)
+        max_relative_error - max_error relative to the largest float64 field
+    """
+    points, _ = flatten_points(x, y, z)
+    if samples is not None and samples < len(points):
+        rng = np.random.default_rng(seed)
+        points = points[rng.choice(len(points), samples, replace=False)]
+
+    reference = calculate_field(
+        coil, points[:, 0], points[:, 1], points[:, 2], **field_options
+    )
+    field_options["dtype"] = dtype
+    result = calculate_field(
+        coil, points[:, 0], points[:, 1], points[:, 2], **field_options
+    )
+    error = np.sqrt(np.sum((result - reference) ** 2, axis=1))
+    return {
+        "points": len(points),
+        "max_error": float(np.max(error)),
+        "max_relative_error": float(
+            np.max(error) / np.max(np.sqrt(np.sum(reference**2, axis=1)))
+        ),
+    }
+
+
+def volume_axes(box_size, start_point, vol_resolution):
+    """
+    Returns the x, y, z sample positions of a target volume, evenly spaced incl. ends.
 
-    return (
-        B * FACTOR
-    )  # return SUM of all components as 3 (x,y,z) meshgrids for (Bx, By, Bz) component when evaluated using produce_target_volume
+    box_size: (x, y, z) dimensions of the box in cm
+    start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box
+    vol_resolution: Spatial resolution (in cm)
+    """
+    return tuple(
+        np.linspace(
+            start_point[i],
+            box_size[i] + start_point[i],
+            int(box_size[i] / vol_resolution) + 1,
+        )
+        for i in range(3)
+    )
 
 
-def produce_target_volume(coil, box_size, start_point, vol_resolution):
+def produce_target_volume(
+    coil,
+    box_size,
+    start_point,
+    vol_resolution,
+    workers=1,
+    tile_size=None,
+    **field_options,
+):
     """
         Generates a set of field vector values for each tuple (x, y, z) in the box.
     ​
@@ -163,28 +736,188 @@ def produce_target_volume(coil, box_size, start_point, vol_resolution):
         box_size: (x, y, z) dimensions of the box in cm
         start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box
         vol_resolution: Spatial resolution (in cm)
+        workers: Number of processes to evaluate the box with, None uses every CPU core.
+        The processes are spawned, so a script using them needs a __main__ guard.
+        tile_size: Number of z planes per tile when the box is split into z-slabs.
+        Defaults to roughly 4 tiles per worker; setting it with workers=1 tiles the
+        serial run to save memory.
+        field_options: Extra keyword arguments passed on to calculate_field (e.g.
+        memory_budget, or dtype=np.float32 for a volume of half the size)
+
+        The tiled and parallel paths give bit-for-bit the same result as the serial one.
+    """
+    x, y, z = volume_axes(box_size, start_point, vol_resolution)
+    return _evaluate_volume(coil, x, y, z, workers, tile_size, field_options)
+
+
+def _evaluate_volume(coil, x, y, z, workers, tile_size, field_options, report=True):
+    """
+    Evaluates the field on the (x, y, z) grid of a target volume, serially in one go,
+    tiled in z-slabs, or with the z-slabs spread over worker processes (see
+    produce_target_volume).
+
+    report: Whether to report progress as the "volume" stage, in tiles
+
+    Returns an (len(x), len(y), len(z), 3) array.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    inst = instrumentation.active()
+    if workers <= 1 and tile_size is None:
+        with inst.stage("grid"):
+            Z, Y, X = np.meshgrid(z, y, x, indexing="ij")
+        # NOTE: Requires axes to be flipped in order for meshgrid to have the correct
+        # dimensional order
+
+        return calculate_field(coil, X, Y, Z, **field_options)
+
+    if tile_size is None:
+        tile_size = -(-len(z) // (4 * workers))
+    tiles = [(z0, min(z0 + tile_size, len(z))) for z0 in range(0, len(z), tile_size)]
+    shape = (len(x), len(y), len(z), 3)
+    dtype = np.dtype(field_options.get("dtype", np.float64))
+
+    inst.count("bytes_allocated", int(np.prod(shape)) * dtype.itemsize)
+    if report:
+        inst.progress("volume", 0, len(tiles))
+
+    if workers <= 1:
+        targetVolume = np.empty(shape, dtype=dtype)
+        for done, (z0, z1) in enumerate(tiles, 1):
+            targetVolume[:, :, z0:z1] = _volume_tile(
+                coil, x, y, z[z0:z1], field_options
+            )
+            if report:
+                inst.progress("volume", done, len(tiles))
+        return targetVolume
+
+    if field_options.get("backend") == "fastest":
+        # pick once here, so every worker runs the same kernel (see calculate_field)
+        tree = field_options.get("method") == "tree"
+        work_dtype = np.dtype(np.float64) if tree else dtype
+        field_options = dict(field_options, backend=fastest_backend(work_dtype))
+    shm = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(shape)) * dtype.itemsize
+    )
+    try:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(tiles)),
+            mp_context=multiprocessing.get_context(POOL_START_METHOD),
+            initializer=_init_volume_worker,
+            initargs=(shm.name, shape, dtype, coil, x, y, z, field_options),
+        ) as pool:
+            # consume the results so any error in a worker is raised here. The workers
+            # have no instrumentation, only the finished tiles are reported.
+            for done, _ in enumerate(pool.map(_volume_worker_tile, tiles), 1):
+                if report:
+                    inst.progress("volume", done, len(tiles))
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _volume_tile(coil, x, y, z, field_options):
+    """
+    Evaluates the field on the (x, y, z) grid of one z-slab of a target volume.
+    """
+    with instrumentation.active().stage("grid"):
+        Z, Y, X = np.meshgrid(z, y, x, indexing="ij")
+    return calculate_field(coil, X, Y, Z, **field_options)
+
+
+# state of a produce_target_volume worker process, set up once by _init_volume_worker
+_volume_worker = {}
+
+
+def _init_volume_worker(shm_name, shape, dtype, coil, x, y, z, field_options):
     """
-    x = np.linspace(
-        start_point[0],
-        box_size[0] + start_point[0],
-        int(box_size[0] / vol_resolution) + 1,
+    Attaches a worker process to the shared result array so the coil and grid are only
+    sent to each worker once.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _volume_worker.update(
+        shm=shm,
+        result=np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+        coil=coil,
+        axes=(x, y, z),
+        field_options=field_options,
     )
-    y = np.linspace(
-        start_point[1],
-        box_size[1] + start_point[1],
-        int(box_size[1] / vol_resolution) + 1,
+
+
+def _volume_worker_tile(tile):
+    """
+    Evaluates the z-slab tile = (z0, z1) and writes it straight into the shared result.
+    """
+    z0, z1 = tile
+    x, y, z = _volume_worker["axes"]
+    _volume_worker["result"][:, :, z0:z1] = _volume_tile(
+        _volume_worker["coil"], x, y, z[z0:z1], _volume_worker["field_options"]
     )
-    z = np.linspace(
-        start_point[2],
-        box_size[2] + start_point[2],
-        int(box_size[2] / vol_resolution) + 1,
+
+
+def produce_target_points(coil, points, **field_options):
+    """
+    Generates the field vector values at an arbitrary list of points.
+
+    Coil: Input Coil Positions, prepared as for produce_target_volume
+    points: (P, 3) positions (x, y, z) in cm
+    field_options: Extra keyword arguments passed on to calculate_field
+
+    Returns a (P, 3) array.
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    return calculate_field(
+        coil, points[:, 0], points[:, 1], points[:, 2], **field_options
     )
-    # Generate points at regular spacing, incl. end points
 
-    Z, Y, X = np.meshgrid(z, y, x, indexing="ij")
-    # NOTE: Requires axes to be flipped in order for meshgrid to have the correct dimensional order
 
-    return calculate_field(coil, X, Y, Z)
+def produce_target_plane(
+    coil,
+    box_size,
+    start_point,
+    vol_resolution,
+    which_plane="z",
+    level=0,
+    **field_options,
+):
+    """
+    Generates the field vector values on one plane of the box, without computing the
+    rest of the volume.
+
+    Coil: Input Coil Positions, prepared as for produce_target_volume
+    box_size, start_point, vol_resolution: The box, as for produce_target_volume
+    which_plane: Plane to evaluate, can be "x", "y" or "z"
+    level: The "height" of the plane, e.g. the Z = 5 plane has a level of 5
+    field_options: Extra keyword arguments passed on to calculate_field
+
+    Returns an array indexed like the volume with the plane axis left out, e.g.
+    [x, y, component] for a "z" plane, so it matches produce_target_volume(...)[:, :, k]
+    on a grid plane.
+    """
+    plane_axis = "xyz".index(which_plane)
+    axes = list(volume_axes(box_size, start_point, vol_resolution))
+    axes[plane_axis] = np.array([level], dtype=float)
+    Z, Y, X = np.meshgrid(axes[2], axes[1], axes[0], indexing="ij")
+    return np.squeeze(calculate_field(coil, X, Y, Z, **field_options), axis=plane_axis)
+
+
+def produce_target_line(coil, start, end, num_points, **field_options):
+    """
+    Generates the field vector values along a straight line, e.g. an axis of the coil.
+
+    Coil: Input Coil Positions, prepared as for produce_target_volume
+    start, end: (x, y, z) end points of the line in cm (both included)
+    num_points: Number of evenly spaced points
+    field_options: Extra keyword arguments passed on to calculate_field
+
+    Returns a (num_points, 3) array.
+    """
+    points = np.linspace(
+        np.asarray(start, dtype=float), np.asarray(end, dtype=float), num_points
+    )
+    return produce_target_points(coil, points, **field_options)
 
 
 def get_field_vector(targetVolume, position, start_point, volume_resolution):
@@ -211,6 +944,46 @@ def get_field_vector(targetVolume, position, start_point, volume_resolution):
     # basic error checking to see if you actually got a correct input/output
 
 
+def interpolate_field(targetVolume, points, box_size, start_point, vol_resolution):
+    """
+    Trilinearly interpolates a generated Target Volume at arbitrary positions.
+
+    targetVolume: Volume indexed as [x, y, z, ...], e.g. from produce_target_volume
+    points: (P, 3) positions (x, y, z) in cm
+    box_size, start_point, vol_resolution: The box the volume was generated for
+
+    Returns a (P, ...) array, NaN for points outside of the box.
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=float))
+    inside = np.ones(len(points), dtype=bool)
+    lower, upper, fraction = [], [], []
+    for i, axis in enumerate(volume_axes(box_size, start_point, vol_resolution)):
+        if len(axis) == 1:
+            u = np.zeros(len(points))
+            inside &= np.isclose(points[:, i], axis[0])
+        else:
+            u = (points[:, i] - axis[0]) / ((axis[-1] - axis[0]) / (len(axis) - 1))
+            inside &= (u > -1e-9) & (u < len(axis) - 1 + 1e-9)
+        i0 = np.clip(np.floor(u).astype(int), 0, max(len(axis) - 2, 0))
+        lower.append(i0)
+        upper.append(np.minimum(i0 + 1, len(axis) - 1))
+        fraction.append(np.clip(u - i0, 0, 1))
+
+    B = np.zeros((len(points),) + targetVolume.shape[3:])
+    for corner in np.ndindex(2, 2, 2):
+        index = [upper[i] if c else lower[i] for i, c in enumerate(corner)]
+        weight = np.prod(
+            [fraction[i] if c else 1 - fraction[i] for i, c in enumerate(corner)],
+            axis=0,
+        )
+        B += (
+            weight.reshape((-1,) + (1,) * (B.ndim - 1))
+            * targetVolume[index[0], index[1], index[2]]
+        )
+    B[~inside] = np.nan
+    return B
+
+
 """
 - If you are indexing a targetvolume meshgrid on your own, remember to account for the offset (starting point), and spatial resolution
 - You will need an index like <relativePosition = ((np.array(position) - np.array(start_point)) / volume_resolution).astype(int)>
@@ -224,6 +997,10 @@ def write_target_volume(
     start_point,
     coil_resolution=1,
     volume_resolution=1,
+    slab_size=None,
+    workers=1,
+    tile_size=None,
+    **field_options,
 ):
     """
     Takes a coil specified in input_filename, generates a target volume, and saves the generated target volume to output_filename.
@@ -232,31 +1009,100 @@ def write_target_volume(
     start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box AKA the offset
     coil_resolution: How long each coil subsegment should be
     volume_resolution: Division of volumetric meshgrid (generate a point every volume_resolution cm)
+    slab_size: Number of x planes computed at a time, defaults to about SLAB_BYTES worth
+    workers, tile_size: Split every slab into z-slabs and spread them over worker
+    processes, as produce_target_volume does
+    field_options: Extra keyword arguments passed on to calculate_field,
+    dtype=np.float32 also stores the volume in float32
+
+    The volume is streamed slab by slab into a memory-mapped .npy file, so it never has
+    to fit in RAM. The box is recorded in a small JSON file next to it (see
+    read_volume_metadata). Progress is reported as the "volume" stage, in x planes (see
+    instrumentation.py).
     """
+    inst = instrumentation.active()
     coil = parse_coil(input_filename)
     chopped = slice_coil(coil, coil_resolution)
-    targetVolume = produce_target_volume(
-        chopped, box_size, start_point, volume_resolution
+    x, y, z = volume_axes(box_size, start_point, volume_resolution)
+
+    dtype = np.dtype(field_options.get("dtype", np.float64))
+    targetVolume = np.lib.format.open_memmap(
+        output_filename, mode="w+", dtype=dtype, shape=(len(x), len(y), len(z), 3)
     )
+    # stored in standard numpy form, x planes are contiguous on disk
+    if slab_size is None:
+        slab_size = max(1, SLAB_BYTES // (targetVolume[0].nbytes))
+    inst.progress("volume", 0, len(x))
+    for x0 in range(0, len(x), slab_size):
+        targetVolume[x0 : x0 + slab_size] = _evaluate_volume(
+            chopped,
+            x[x0 : x0 + slab_size],
+            y,
+            z,
+            workers,
+            tile_size,
+            field_options,
+            report=False,
+        )
+        inst.progress("volume", min(x0 + slab_size, len(x)), len(x))
+
+    with inst.stage("save"):
+        targetVolume.flush()
+        del targetVolume
+
+        write_volume_metadata(
+            output_filename,
+            box_size,
+            start_point,
+            volume_resolution,
+            coil=str(input_filename),
+            coil_resolution=coil_resolution,
+            dtype=dtype.name,
+        )
+
+
+def write_volume_metadata(filename, box_size, start_point, vol_resolution, **extra):
+    """
+    Records the box a target volume was generated for, in
+    filename + VOLUME_METADATA_SUFFIX.
+
+    extra: Any other JSON serialisable values to store alongside
+    """
+    metadata = {
+        "box_size": [float(v) for v in box_size],
+        "start_point": [float(v) for v in start_point],
+        "vol_resolution": float(vol_resolution),
+    }
+    metadata.update(extra)
+    with open(str(filename) + VOLUME_METADATA_SUFFIX, "w") as f:
+        json.dump(metadata, f, indent=2)
+
 
-    with open(output_filename, "wb") as f:
-        np.save(f, targetVolume)
-    # stored in standard numpy pickle form
+def read_volume_metadata(filename):
+    """
+    Loads the box_size, start_point and vol_resolution saved with a target volume.
+    Returns None if the volume has no metadata.
+    """
+    try:
+        with open(str(filename) + VOLUME_METADATA_SUFFIX, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
 
 
-def read_target_volume(filename):
+def read_target_volume(filename, mmap_mode="r"):
     """
     Takes the name of a saved target volume and loads the B vector meshgrid.
     Returns None if not found.
-    """
-    targetVolume = None
 
+    mmap_mode: By default the volume is memory-mapped read-only, so slicing it only
+    reads the pages that are needed. Use "c" for a writable copy-on-write map or None
+    to load it all.
+    """
     try:
-        with open(filename, "rb") as f:
-            targetVolume = np.load(f)
-        return targetVolume
-    except:
-        pass
+        return np.load(filename, mmap_mode=mmap_mode)
+    except FileNotFoundError:
+        return None
 
 
 ## plotting routines
@@ -270,57 +1116,58 @@ def plot_fields(
     which_plane="z",
     level=0,
     num_contours=50,
+    coil=None,
+    **field_options,
 ):
     """
     Plots the set of Bfields in the given region, at the specified resolutions.
 
-    Bfields: A 4D array of the Bfield.
+    Bfields: A 4D array of the Bfield. Can be None when a coil is given.
     box_size: (x, y, z) dimensions of the box in cm
     start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box AKA the offset
     vol_resolution: Division of volumetric meshgrid (generate a point every volume_resolution cm)
     which_plane: Plane to plot on, can be "x", "y" or "z"
     level : The "height" of the plane. For instance the Z = 5 plane would have a level of 5
     num_contours: THe amount of contours on the contour plot.
+    coil: Instead of slicing Bfields, evaluate just the plotted plane of this coil with
+    produce_target_plane (field_options are passed on to calculate_field)
 
     """
 
     # filled contour plot of Bx, By, and Bz on a chosen slice plane
-    X = np.linspace(
-        start_point[0],
-        box_size[0] + start_point[0],
-        int(box_size[0] / vol_resolution) + 1,
-    )
-    Y = np.linspace(
-        start_point[1],
-        box_size[1] + start_point[1],
-        int(box_size[1] / vol_resolution) + 1,
-    )
-    Z = np.linspace(
-        start_point[2],
-        box_size[2] + start_point[2],
-        int(box_size[2] / vol_resolution) + 1,
-    )
-
-    print(Z)
+    X, Y, Z = volume_axes(box_size, start_point, vol_resolution)
 
     if which_plane == "x":
 
         converted_level = np.where(X >= level)
-        B_sliced = [Bfields[converted_level[0][0], :, :, i].T for i in range(3)]
+        plane_axis, plane_level = 0, X[converted_level[0][0]]
         x_label, y_label = "y", "z"
         x_array, y_array = Y, Z
     elif which_plane == "y":
         converted_level = np.where(Y >= level)
-        B_sliced = [Bfields[:, converted_level[0][0], :, i].T for i in range(3)]
+        plane_axis, plane_level = 1, Y[converted_level[0][0]]
         x_label, y_label = "x", "z"
         x_array, y_array = X, Z
     else:
         converted_level = np.where(Z >= level)
-        print(converted_level[0][0])
-        B_sliced = [Bfields[:, :, converted_level[0][0], i].T for i in range(3)]
+        plane_axis, plane_level = 2, Z[converted_level[0][0]]
         x_label, y_label = "x", "y"
         x_array, y_array = X, Y
 
+    if coil is not None:
+        B_plane = produce_target_plane(
+            coil,
+            box_size,
+            start_point,
+            vol_resolution,
+            "xyz"[plane_axis],
+            plane_level,
+            **field_options,
+        )
+    else:
+        B_plane = Bfields[(slice(None),) * plane_axis + (converted_level[0][0],)]
+    B_sliced = [B_plane[:, :, i].T for i in range(3)]
+
     Bmin, Bmax = np.amin(B_sliced), np.amax(B_sliced)
 
     component_labels = ["x", "y", "z"]
@@ -415,36 +1262,10 @@ def create_B_x_rectangle(name, p0=[-21.59, -38.1, -21.59, 1], L=76.20, W=43.18):
     L: Length (on Z)
     W: Width (on y)
     """
-    f = open(name, "w")
-
-    p1 = [p0[0], p0[1] + W, p0[2], p0[3]]
-    p2 = [p0[0], p0[1] + W, p0[2] + L, p0[3]]
-    p3 = [p0[0], p0[1], p0[2] + L, p0[3]]
-
-    line = str(p0)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p1)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p2)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p3)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p0)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-    f.close()
+    write_coil(name, coil_geometry.rectangle(p0[:3], (0, W, 0), (0, 0, L), p0[3]))
 
 
 def create_B_y_rectangle(name, p0=[-21.59, -38.1, -21.59, 1], L=76.20, D=43.18):
-
     """
     Creates a rectangle of the X-Z plane that produces a B_y field.
 
@@ -453,32 +1274,7 @@ def create_B_y_rectangle(name, p0=[-21.59, -38.1, -21.59, 1], L=76.20, D=43.18):
     L: Length (on Z)
     D: Depth (on X)
     """
-    f = open(name, "w")
-
-    p1 = [p0[0], p0[1], p0[2] + L, p0[3]]
-    p2 = [p0[0] + D, p0[1], p0[2] + L, p0[3]]
-    p3 = [p0[0] + D, p0[1], p0[2], p0[3]]
-
-    line = str(p0)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p1)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p2)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p3)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p0)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-    f.close()
+    write_coil(name, coil_geometry.rectangle(p0[:3], (0, 0, L), (D, 0, 0), p0[3]))
 
 
 def create_B_z_rectangle(name, p0=[-26.67, -26.67, -26.67, 1], H=53.340, DD=53.340):
@@ -490,33 +1286,7 @@ def create_B_z_rectangle(name, p0=[-26.67, -26.67, -26.67, 1], H=53.340, DD=53.3
     H: Height (on Y)
     DD: Depth (on X)
     """
-    f = open(name, "w")
-
-    p1 = [p0[0] + DD, p0[1], p0[2], p0[3]]
-    p2 = [p0[0] + DD, p0[1] + H, p0[2], p0[3]]
-    p3 = [p0[0], p0[1] + H, p0[2], p0[3]]
-
-    line = str(p0)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p1)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p2)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p3)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    line = str(p0)
-    line = line[1 : len(line) - 1] + "\n"
-    f.write(line)
-
-    f.close()
+    write_coil(name, coil_geometry.rectangle(p0[:3], (DD, 0, 0), (0, H, 0), p0[3]))
 
 
 def helmholtz_coils(fname1, fname2, numSegments, radius, spacing, current):
@@ -529,38 +1299,12 @@ def helmholtz_coils(fname1, fname2, numSegments, radius, spacing, current):
     radius: Radius of the coils
     spacing: Spacing between the coils. The first coil will be located at -spacing/2 and the 2nd coil will be located at spacing/2 on the Z plane
     current: The current that goest through each coil.
+
+    Use coil_geometry.helmholtz_pair to get the coils as arrays instead.
     """
-    f = open(fname1, "w")
-    line = ""
-    for i in range(0, numSegments, 1):
-        line = (
-            str(np.cos(2 * np.pi * (i) / (numSegments - 1)) * radius)
-            + ","
-            + str(np.sin(2 * np.pi * (i) / (numSegments - 1)) * radius)
-            + ","
-            + str(-spacing / 2.0)
-            + ","
-            + str(current)
-            + "\n"
-        )
-        f.write(line)
-    f.close()
-
-    f = open(fname2, "w")
-    line = ""
-    for i in range(0, numSegments, 1):
-        line = (
-            str(np.cos(2 * np.pi * (i) / (numSegments - 1)) * radius)
-            + ","
-            + str(np.sin(2 * np.pi * (i) / (numSegments - 1)) * radius)
-            + ","
-            + str(spacing / 2.0)
-            + ","
-            + str(current)
-            + "\n"
-        )
-        f.write(line)
-    f.close()
+    coil1, coil2 = coil_geometry.helmholtz_pair(numSegments, radius, spacing, current)
+    write_coil(fname1, coil1)
+    write_coil(fname2, coil2)
 
 
 def create_Bx_circle(fname, numSegments, radius, spacing, current, center):
@@ -574,21 +1318,12 @@ def create_Bx_circle(fname, numSegments, radius, spacing, current, center):
     current: The current that goest through the coil.
     center: (y,z) The center of the coil on the Y-Z plane
     """
-    f = open(fname, "w")
-    line = ""
-    for i in range(0, numSegments, 1):
-        line = (
-            str(spacing)
-            + ","
-            + str(np.cos(2 * np.pi * (i) / (numSegments - 1)) * radius + center[0])
-            + ","
-            + str(np.sin(2 * np.pi * (i) / (numSegments - 1)) * radius + center[1])
-            + ","
-            + str(current)
-            + "\n"
-        )
-        f.write(line)
-    f.close()
+    write_coil(
+        fname,
+        coil_geometry.circle(
+            numSegments, radius, current, (spacing, center[0], center[1]), axis="x"
+        ),
+    )
 
 
 def create_By_circle(fname, numSegments, radius, spacing, current, center):
@@ -602,21 +1337,12 @@ def create_By_circle(fname, numSegments, radius, spacing, current, center):
     current: The current that goest through the coil.
     center: (x,z) The center of the coil on the X-Z plane
     """
-    f = open(fname, "w")
-    line = ""
-    for i in range(0, numSegments, 1):
-        line = (
-            str(np.cos(2 * np.pi * (i) / (numSegments - 1)) * radius + center[0])
-            + ","
-            + str(spacing)
-            + ","
-            + str(np.sin(2 * np.pi * (i) / (numSegments - 1)) * radius + center[1])
-            + ","
-            + str(current)
-            + "\n"
-        )
-        f.write(line)
-    f.close()
+    write_coil(
+        fname,
+        coil_geometry.circle(
+            numSegments, radius, current, (center[0], spacing, center[1]), axis="y"
+        ),
+    )
 
 
 def create_Bz_circle(fname, numSegments, radius, spacing, current, center):
@@ -630,18 +1356,9 @@ def create_Bz_circle(fname, numSegments, radius, spacing, current, center):
     current: The current that goest through the coil.
     center: (x,y) The center of the coil on the X-Y plane
     """
-    f = open(fname, "w")
-    line = ""
-    for i in range(0, numSegments, 1):
-        line = (
-            str(np.cos(2 * np.pi * (i) / (numSegments - 1)) * radius + center[0])
-            + ","
-            + str(np.sin(2 * np.pi * (i) / (numSegments - 1)) * radius + center[1])
-            + ","
-            + str(spacing)
-            + ","
-            + str(current)
-            + "\n"
-        )
-        f.write(line)
-    f.close()
+    write_coil(
+        fname,
+        coil_geometry.circle(
+            numSegments, radius, current, (center[0], center[1], spacing), axis="z"
+        ),
+    )
@@ -0,0 +1,203 @@
+"""
+Coil shapes and transforms on (4, N) coil arrays.
+
+The builders return coils in the same x, y, z, I layout parse_coil produces, so a scene
+can be put together and simulated without writing and re-reading CSV files. The
+transforms all return new arrays and leave their input alone; write_coil in
+biot_savart_v4_3 saves the result if a CSV file is needed after all.
+
+    pair = helmholtz_pair(100, 5, 5, 1)
+    stator = concatenate(
+        *[offset(rotate(coil, angle), 2, angle) for angle in range(0, 360, 60)]
+    )
+
+All lengths are in cm, currents are in A, angles are in degrees
+"""
+
+import numpy as np
+
+AXES = "xyz"
+
+
+def _as_coil(coil):
+    """
+    Returns a float copy of a (4, N) coil.
+    """
+    coil = np.array(coil, dtype=float)
+    if coil.ndim != 2 or coil.shape[0] != 4:
+        raise ValueError("expected a (4, N) coil, got shape {}".format(coil.shape))
+    return coil
+
+
+def from_points(points, current, z=0, scale=1):
+    """
+    Turns a track, e.g. the (N, 2) points from the generator notebooks, into a coil.
+
+    points: (N, 2) or (N, 3) positions, (N, 2) tracks are placed at height z
+    current: Current through the track, one value or one per point
+    scale: Factor applied to the positions, e.g. 0.1 for tracks drawn in mm
+    """
+    points = np.asarray(points, dtype=float)
+    coil = np.empty((4, len(points)))
+    coil[: points.shape[1]] = points.T * scale
+    if points.shape[1] == 2:
+        coil[2] = z
+    coil[3] = current
+    return coil
+
+
+def circle(num_segments, radius, current, center=(0, 0, 0), axis="z"):
+    """
+    A closed circular loop of num_segments vertices (the last one repeats the first), in
+    the plane normal to axis, going anti-clockwise around it.
+
+    center: (x, y, z) centre of the loop
+    """
+    angle = 2 * np.pi * np.arange(num_segments) / (num_segments - 1)
+    # the two in-plane axes, in the order create_B*_circle have always used
+    u, v = [i for i in range(3) if i != AXES.index(axis)]
+    coil = np.empty((4, num_segments))
+    coil[:3] = np.asarray(center, dtype=float)[:, None]
+    coil[u] += np.cos(angle) * radius
+    coil[v] += np.sin(angle) * radius
+    coil[3] = current
+    return coil
+
+
+def rectangle(corner, first, second, current):
+    """
+    A closed rectangular loop corner -> corner + first -> corner + first + second ->
+    corner + second -> corner.
+
+    corner: (x, y, z) starting point
+    first, second: (x, y, z) vectors along the two sides
+    """
+    corner, first, second = (
+        np.asarray(v, dtype=float) for v in (corner, first, second)
+    )
+    coil = np.empty((4, 5))
+    coil[:3] = np.stack(
+        (corner, corner + first, corner + first + second, corner + second, corner),
+        axis=1,
+    )
+    coil[3] = current
+    return coil
+
+
+def helmholtz_pair(num_segments, radius, spacing, current):
+    """
+    Returns the two loops of a pair of Helmholtz coils parallel to the X-Y plane, at
+    z = -spacing / 2 and z = spacing / 2.
+    """
+    return (
+        circle(num_segments, radius, current, (0, 0, -spacing / 2)),
+        circle(num_segments, radius, current, (0, 0, spacing / 2)),
+    )
+
+
+def translate(coil, vector):
+    """
+    Moves a coil by vector = (dx, dy, dz).
+    """
+    coil = _as_coil(coil)
+    coil[:3] += np.asarray(vector, dtype=float)[:, None]
+    return coil
+
+
+def offset(coil, distance, angle):
+    """
+    Moves a coil out by distance in the direction of angle in the X-Y plane, like
+    helpers.translate does for tracks.
+    """
+    return translate(
+        coil,
+        (distance * np.cos(np.deg2rad(angle)), distance * np.sin(np.deg2rad(angle)), 0),
+    )
+
+
+def rotate(coil, angle, axis="z", center=(0, 0, 0)):
+    """
+    Rotates a coil anti-clockwise by angle around an axis through center.
+    """
+    coil = _as_coil(coil)
+    u, v = [i for i in range(3) if i != AXES.index(axis)]
+    if axis == "y":
+        # keep the rotation right handed: z -> x
+        u, v = v, u
+    c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+    center = np.asarray(center, dtype=float)
+    pu, pv = coil[u] - center[u], coil[v] - center[v]
+    coil[u] = pu * c - pv * s + center[u]
+    coil[v] = pu * s + pv * c + center[v]
+    return coil
+
+
+def mirror(coil, axis="y"):
+    """
+    Flips the sign of one coordinate, like helpers.flip_y and flip_x do for tracks.
+    """
+    coil = _as_coil(coil)
+    coil[AXES.index(axis)] *= -1
+    return coil
+
+
+def reverse(coil):
+    """
+    Runs a coil backwards. The currents move with the segments, so every segment keeps
+    its current and the field flips sign.
+    """
+    coil = _as_coil(coil)
+    current = coil[3, :-1][::-1]
+    coil = coil[:, ::-1].copy()
+    coil[3, :-1] = current
+    coil[3, -1] = current[-1] if len(current) else coil[3, -1]
+    return coil
+
+
+def scale_current(coil, factor):
+    """
+    Multiplies the current of a coil by factor.
+    """
+    coil = _as_coil(coil)
+    coil[3] *= factor
+    return coil
+
+
+def concatenate(*coils, connect=False):
+    """
+    Joins coils into one array.
+
+    connect: Whether current flows along the segment from the end of each coil to the
+    start of the next (e.g. through a via). By default that segment carries no current,
+    so the coils stay electrically separate and their fields simply add up.
+    """
+    coils = [_as_coil(coil) for coil in coils]
+    if not connect:
+        for coil in coils[:-1]:
+            coil[3, -1] = 0
+    return np.concatenate(coils, axis=1)
+
+
+def stack_layers(layers, z_levels, connect=True):
+    """
+    Places the layers of a multi-layer coil at the given heights and joins them in
+    series, the way the generator notebooks write the 2 and 4 layer CSV files, e.g.
+    stack_layers([reverse(front), back], [0, -0.062]).
+
+    layers: Coils (or one coil used for every layer), each running in the direction the
+    current takes through that layer
+    z_levels: Height of each layer, replacing the layer's own z
+    connect: Whether the current flows from the end of each layer to the next one's start
+    """
+    if isinstance(layers, np.ndarray) and layers.ndim == 2:
+        layers = [layers] * len(z_levels)
+    if len(layers) != len(z_levels):
+        raise ValueError(
+            "got {} layers but {} z levels".format(len(layers), len(z_levels))
+        )
+    placed = []
+    for layer, z in zip(layers, z_levels):
+        layer = _as_coil(layer)
+        layer[2] = z
+        placed.append(layer)
+    return concatenate(*placed, connect=connect)
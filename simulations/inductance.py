@@ -0,0 +1,351 @@
+"""
+Trace length, DC resistance and inductance of coils.
+
+Inductances come from the Neumann integral
+
+    M = mu_0 / 4pi  sum  dl_a . dl_b / |r_a - r_b|
+
+evaluated in blocks of segment pairs. The track is first resampled into segments of
+about steplength (merging the very short segments of finely drawn spirals as well as
+splitting long ones). The inner integral along each straight segment is done exactly,
+the outer one with Gauss-Legendre points, so close segments (tracks on the next layer)
+are handled without slicing the coil very finely; segments that meet along the track
+use the exact integral. Self-inductance uses the thin wire form of the same integral
+(Dengler, 2016): pairs of points closer than half the wire's radius along the track are
+left out, and mu_0 / 4pi * length / 2 is added for the field inside the copper.
+
+Coils can be given as (4, N) arrays from parse_coil or coil_geometry (in cm, with the
+currents only used as relative weights, so zero-current joins are skipped and reversed
+sections count negatively) or as the lists of (x, y) track points from the generator
+notebooks (in mm).
+
+All lengths are in cm, resistance is in ohm, inductance is in H
+"""
+
+import numpy as np
+
+from biot_savart_v4_3 import DEFAULT_MEMORY_BUDGET, block_sizes
+from coil_geometry import from_points
+
+# Resistivity of copper at 20 C (in ohm cm)
+COPPER_RESISTIVITY = 1.68e-6
+
+# Default track: the generator notebooks' 0.127 mm track in 1 oz (35 um) copper (in cm)
+TRACK_WIDTH = 0.0127
+COPPER_THICKNESS = 0.0035
+
+# Default length the tracks are resampled to for the Neumann integral (in cm)
+DEFAULT_STEPLENGTH = 0.05
+
+# mu_0 / 4pi in H/cm
+MU0_4PI = 1e-9
+
+
+def as_coil(coil, z=0):
+    """
+    Returns a (4, N) coil array in cm. Lists of (x, y) points, as the generator
+    notebooks build them, are taken to be tracks in mm at height z.
+    """
+    if isinstance(coil, (list, tuple)):
+        return from_points(coil, 1, z, scale=0.1)
+    coil = np.asarray(coil, dtype=float)
+    if coil.ndim != 2 or coil.shape[0] != 4:
+        raise ValueError("expected a (4, N) coil, got shape {}".format(coil.shape))
+    return coil
+
+
+def equivalent_radius(track_width=TRACK_WIDTH, copper_thickness=COPPER_THICKNESS):
+    """
+    Radius of the round wire with the same self-inductance as a rectangular track, from
+    the geometric mean distance of the rectangle, 0.2235 (w + t), and
+    GMD = radius / e^(1/4).
+    """
+    return 0.2235 * (track_width + copper_thickness) * np.exp(0.25)
+
+
+def trace_length(coil):
+    """
+    Total length of the current carrying segments of a coil (in cm).
+    """
+    coil = as_coil(coil)
+    lengths = np.sqrt(np.sum(np.diff(coil[:3], axis=1) ** 2, axis=0))
+    return float(np.sum(lengths[coil[3, :-1] != 0]))
+
+
+def dc_resistance(
+    coil,
+    track_width=TRACK_WIDTH,
+    copper_thickness=COPPER_THICKNESS,
+    resistivity=COPPER_RESISTIVITY,
+):
+    """
+    DC resistance of a coil's track in ohm, R = resistivity * length / (width * thickness).
+    """
+    return resistivity * trace_length(coil) / (track_width * copper_thickness)
+
+
+def _resample(coil, steplength):
+    """
+    Redraws every run of segments carrying the same current as evenly spaced points
+    about steplength apart along the track, so short segments are merged as well as long
+    ones split. Segments that carry no current are kept as they are.
+    """
+    weights = coil[3, :-1]
+    # vertex index where every run of equal current starts, and the last vertex
+    breaks = np.concatenate(
+        ([0], 1 + np.flatnonzero(np.diff(weights) != 0), [len(weights)])
+    )
+    pieces = []
+    for first, last in zip(breaks[:-1], breaks[1:]):
+        run = coil[:, first : last + 1]
+        if weights[first] == 0:
+            pieces.append(run[:, :-1])
+            continue
+        along = np.concatenate(
+            ([0], np.cumsum(np.sqrt(np.sum(np.diff(run[:3], axis=1) ** 2, axis=0))))
+        )
+        count = max(1, int(np.ceil(along[-1] / steplength)))
+        targets = np.linspace(0, along[-1], count + 1)[:-1]
+        piece = np.empty((4, count))
+        for axis in range(3):
+            piece[axis] = np.interp(targets, along, run[axis])
+        piece[3] = weights[first]
+        pieces.append(piece)
+    pieces.append(coil[:, -1:])
+    return np.concatenate(pieces, axis=1)
+
+
+def _segments(coil, steplength):
+    """
+    Resamples a coil into segments of about steplength and returns their starts, ends
+    and relative current weights, without the segments that carry no current.
+    """
+    coil = as_coil(coil)
+    if steplength is not None:
+        coil = _resample(coil, steplength)
+    weights = coil[3, :-1] / np.max(np.abs(coil[3]))
+    keep = (weights != 0) & np.any(coil[:3, 1:] != coil[:3, :-1], axis=0)
+    return coil[:3, :-1].T[keep], coil[:3, 1:].T[keep], weights[keep]
+
+
+def _quadrature(starts, ends, weights, quadrature_points):
+    """
+    Gauss-Legendre points along every segment, with their weighted dl vectors.
+
+    Returns (points (Q, 3), dl (Q, 3), segment index (Q,)).
+    """
+    nodes, node_weights = np.polynomial.legendre.leggauss(quadrature_points)
+    fraction = (nodes + 1) / 2
+    dl = ends - starts
+    points = starts[:, None, :] + fraction[None, :, None] * dl[:, None, :]
+    point_weights = weights[:, None, None] * node_weights[None, :, None] / 2
+    point_dl = point_weights * dl[:, None, :]
+    index = np.repeat(np.arange(len(starts)), quadrature_points)
+    return points.reshape(-1, 3), point_dl.reshape(-1, 3), index
+
+
+def _line_potential(starts, ends, points):
+    """
+    Integral of ds / |r - point| along straight segments, broadcasting starts and ends
+    (..., 3) against points (..., 3). Returns (segment directions, integrals).
+    """
+    dl = ends - starts
+    u = dl / np.sqrt(np.sum(dl**2, axis=-1))[..., None]
+    a = starts - points
+    b = ends - points
+    la = np.sqrt(np.sum(a**2, axis=-1))
+    lb = np.sqrt(np.sum(b**2, axis=-1))
+    au = np.sum(a * u, axis=-1)
+    bu = np.sum(b * u, axis=-1)
+    # the integral is log((|b| + b.u) / (|a| + a.u)), written the other way round where
+    # the point lies beyond the segment's start to avoid cancellation
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ahead = au + bu >= 0
+        potential = np.where(
+            ahead,
+            np.log((lb + bu) / (la + au)),
+            np.log((la - au) / (lb - bu)),
+        )
+    return u, potential
+
+
+def _segment_potential_block(starts, ends, weights, points, point_dl):
+    """
+    sum over points and segments of (dl_point . u) * weight * integral of
+    ds / |r - point| along the segment, with u the segment's direction. Returns a (P, K)
+    array of terms.
+    """
+    u, potential = _line_potential(
+        starts[None, :, :], ends[None, :, :], points[:, None, :]
+    )
+    return (point_dl @ u[0].T) * weights[None, :] * potential
+
+
+def _junction_correction(starts, ends, weights, radius, quadrature_points):
+    """
+    Correction to the Neumann sum of one coil for the pairs of segments that follow each
+    other along the track (without mu_0 / 4pi).
+
+    The Gauss-Legendre points cannot follow the log singularity where two segments meet,
+    so their quadrature terms are swapped for the exact integral of two straight pieces
+    meeting at a point (Grover),
+        2 cos(e) (l1 atanh(l2 / (l1 + R)) + l2 atanh(l1 / (l2 + R)))
+    for each order of the pair, with e the angle between them and R the distance between
+    their free ends. Like inside a segment, the pairs closer than radius / 2 across the
+    joint are left out, radius / 2 * cos(e) for each order.
+    """
+    first = np.flatnonzero(np.all(ends[:-1] == starts[1:], axis=1))
+    second = first + 1
+    if len(starts) > 1 and np.all(ends[-1] == starts[0]):
+        first, second = np.append(first, len(starts) - 1), np.append(second, 0)
+    if len(first) == 0:
+        return 0.0
+
+    nodes, node_weights = np.polynomial.legendre.leggauss(quadrature_points)
+    fraction = (nodes + 1) / 2
+    direction = ends - starts
+    length = np.sqrt(np.sum(direction**2, axis=1))
+    pair_weight = weights[first] * weights[second]
+
+    quadrature = 0.0
+    for outer, inner in ((first, second), (second, first)):
+        dl = ends[outer] - starts[outer]
+        points = starts[outer][:, None, :] + fraction[None, :, None] * dl[:, None, :]
+        u, potential = _line_potential(
+            starts[inner][:, None, :], ends[inner][:, None, :], points
+        )
+        cosine = np.sum(dl[:, None, :] * u, axis=2)
+        quadrature += np.sum(
+            pair_weight[:, None] * node_weights / 2 * cosine * potential
+        )
+
+    l1, l2 = length[first], length[second]
+    cosine = np.sum(direction[first] * direction[second], axis=1) / (l1 * l2)
+    R = np.sqrt(np.sum((ends[second] - starts[first]) ** 2, axis=1))
+    exact = (
+        2 * cosine * (l1 * np.arctanh(l2 / (l1 + R)) + l2 * np.arctanh(l1 / (l2 + R)))
+    )
+    return np.sum(pair_weight * (2 * exact - radius * cosine)) - quadrature
+
+
+def _neumann_sum(segments_a, segments_b, quadrature_points, memory_budget, same=False):
+    """
+    Adds up the Neumann integral between two sets of segments (without mu_0 / 4pi), with
+    the quadrature points on segments_a. With same=True the two sets are one coil and
+    the diagonal (a segment with itself) is left out.
+    """
+    points, point_dl, index = _quadrature(*segments_a, quadrature_points)
+    starts, ends, weights = segments_b
+    segment_block, point_block = block_sizes(len(starts), len(points), memory_budget)
+    total = 0.0
+    for p in range(0, len(points), point_block):
+        block = slice(p, p + point_block)
+        for s in range(0, len(starts), segment_block):
+            terms = _segment_potential_block(
+                starts[s : s + segment_block],
+                ends[s : s + segment_block],
+                weights[s : s + segment_block],
+                points[block],
+                point_dl[block],
+            )
+            if same:
+                terms[index[block, None] == np.arange(s, s + terms.shape[1])] = 0
+            total += np.sum(terms)
+    return total
+
+
+def self_inductance(
+    coil,
+    track_width=TRACK_WIDTH,
+    copper_thickness=COPPER_THICKNESS,
+    steplength=DEFAULT_STEPLENGTH,
+    quadrature_points=2,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """
+    Low frequency self-inductance of a coil (in H), including the coupling between its
+    layers.
+
+    track_width, copper_thickness: Cross-section of the track, see equivalent_radius
+    steplength: Length the track is resampled to (None to use its segments as they are).
+    It can not be below the track's equivalent radius, the thin wire terms need segments
+    at least half the radius long.
+    quadrature_points: Gauss-Legendre points per segment for the outer integral. With 2,
+    a round loop (R = 1 cm, a = 0.1 mm) comes within 0.1% of its analytic inductance for
+    steplengths from the radius up to 0.1 cm.
+    """
+    radius = equivalent_radius(track_width, copper_thickness)
+    if steplength is not None and steplength < radius:
+        raise ValueError(
+            "steplength {} is below the track's equivalent radius {}".format(
+                steplength, radius
+            )
+        )
+    segments = _segments(coil, steplength)
+    starts, ends, weights = segments
+    length = np.sqrt(np.sum((ends - starts) ** 2, axis=1))
+
+    # a straight piece of length l with itself, leaving out |s - s'| < radius / 2
+    own = np.where(
+        length > radius / 2,
+        2 * (length * np.log(2 * length / radius) - length + radius / 2),
+        0,
+    )
+    total = (
+        _neumann_sum(segments, segments, quadrature_points, memory_budget, same=True)
+        + _junction_correction(starts, ends, weights, radius, quadrature_points)
+        + np.sum(weights**2 * own)
+        # internal inductance of a round wire at DC, Y = 1/2
+        + np.sum(weights**2 * length) / 2
+    )
+    return MU0_4PI * total
+
+
+def mutual_inductance(
+    coil_a,
+    coil_b,
+    steplength=DEFAULT_STEPLENGTH,
+    quadrature_points=2,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """
+    Mutual inductance between two separate coils (in H), e.g. two coils of a stator or
+    two layers that are not connected in series.
+    """
+    return MU0_4PI * _neumann_sum(
+        _segments(coil_a, steplength),
+        _segments(coil_b, steplength),
+        quadrature_points,
+        memory_budget,
+    )
+
+
+def inductance_matrix(
+    coils,
+    track_width=TRACK_WIDTH,
+    copper_thickness=COPPER_THICKNESS,
+    steplength=DEFAULT_STEPLENGTH,
+    quadrature_points=2,
+    mutual_quadrature_points=2,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """
+    Returns the (n, n) inductance matrix of a list of coils (in H): self-inductances on
+    the diagonal, mutual inductances off it.
+    """
+    coils = [as_coil(coil) for coil in coils]
+    matrix = np.empty((len(coils), len(coils)))
+    for i, coil in enumerate(coils):
+        matrix[i, i] = self_inductance(
+            coil,
+            track_width,
+            copper_thickness,
+            steplength,
+            quadrature_points,
+            memory_budget,
+        )
+        for j in range(i):
+            matrix[i, j] = matrix[j, i] = mutual_inductance(
+                coil, coils[j], steplength, mutual_quadrature_points, memory_budget
+            )
+    return matrix
@@ -0,0 +1,179 @@
+"""
+Timers, counters and progress reports for long field computations.
+
+The simulator reports what it is doing to the active instrumentation:
+    stages - wall time spent in "parse", "slice", "grid", "integrate" and "save"
+    counters - "segments" and "points" fed to the kernel and "bytes_allocated" for the
+    kernel scratch space and results
+    progress - (stage, done, total, eta) as calculate_field works through its blocks
+    ("integrate") and produce_target_volume through its tiles ("volume")
+
+By default the active instrumentation is a NullInstrumentation that ignores everything.
+To collect numbers, run the computation inside instrumented():
+
+    with instrumented(print_progress) as inst:
+        bs.write_target_volume(
+            "coils/coil.csv", "volume.npy", (30, 15, 15), (-5, -0.5, -7.5)
+        )
+    print(inst.summary())
+"""
+
+import contextlib
+import functools
+import sys
+import time
+
+
+class NullInstrumentation:
+    """
+    Instrumentation that records nothing, used whenever instrumented() is not active.
+    """
+
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, name, amount=1):
+        pass
+
+    def progress(self, stage, done, total):
+        pass
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Instrumentation:
+    """
+    Collects stage timers and counters and forwards progress reports to a callback.
+
+    callback: Called as callback(stage, done, total, eta) on every progress report, eta
+    is the estimated number of seconds left in the stage (None until there is anything
+    to go by)
+    """
+
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.timers = {}
+        self.counters = {}
+        self._progress_start = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Adds the wall time spent inside the with block to the timer of stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, amount=1):
+        """
+        Adds amount to the counter name.
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def progress(self, stage, done, total):
+        """
+        Reports that done out of total units of work of a stage are finished. A report
+        with done = 0 (re)starts the clock the ETA is measured from.
+        """
+        now = time.perf_counter()
+        if done == 0 or stage not in self._progress_start:
+            self._progress_start[stage] = now
+        elapsed = now - self._progress_start[stage]
+        eta = elapsed * (total - done) / done if done > 0 else None
+        if self.callback is not None:
+            self.callback(stage, done, total, eta)
+
+    def report(self):
+        """
+        Returns the timers and counters as a dict.
+        """
+        return {"timers": dict(self.timers), "counters": dict(self.counters)}
+
+    def summary(self):
+        """
+        Returns the timers and counters as a printable table.
+        """
+        lines = [
+            "{:<20} {:>12.3f} s".format(name, seconds)
+            for name, seconds in self.timers.items()
+        ]
+        lines += [
+            "{:<20} {:>12}".format(name, value) for name, value in self.counters.items()
+        ]
+        return "\n".join(lines)
+
+
+_active = NullInstrumentation()
+
+
+def active():
+    """
+    Returns the instrumentation the simulator currently reports to.
+    """
+    return _active
+
+
+def set_active(instrumentation):
+    """
+    Makes instrumentation the one the simulator reports to, None switches it off again.
+    Returns the previously active instrumentation.
+    """
+    global _active
+    previous = _active
+    _active = NullInstrumentation() if instrumentation is None else instrumentation
+    return previous
+
+
+@contextlib.contextmanager
+def instrumented(callback=None, instrumentation=None):
+    """
+    Makes an Instrumentation (or the one given) active for the duration of the with
+    block and yields it.
+
+    callback: Progress callback for a new Instrumentation, e.g. print_progress
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation(callback)
+    previous = set_active(instrumentation)
+    try:
+        yield instrumentation
+    finally:
+        set_active(previous)
+
+
+def timed(stage):
+    """
+    Decorator that times every call of a function as the given stage, when
+    instrumentation is active.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _active.enabled:
+                return function(*args, **kwargs)
+            with _active.stage(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def print_progress(stage, done, total, eta):
+    """
+    Progress callback that keeps a single status line up to date on stderr.
+    """
+    line = "\r{:<10} {:6.1%}".format(stage, done / total if total else 1.0)
+    if eta is not None:
+        line += "  ETA {:7.1f} s".format(eta)
+    sys.stderr.write(line + ("\n" if done >= total else ""))
+    sys.stderr.flush()
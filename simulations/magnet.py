@@ -0,0 +1,320 @@
+"""
+Permanent magnet model and the forces it exerts on coils.
+
+Port of the magnet model in magnetic_force_on_coils.ipynb: a cylindrical magnet of
+diameter d and length l is modelled as two rings of point dipoles (at +l/2 and -l/2,
+both rings 3/4 of the real size), each dipole carrying an equal share of the moment m.
+Instead of calling the model once per coil segment, the field is evaluated for every
+segment in one array operation.
+
+Like the notebook, this works in SI units: lengths are in m, B-field is in T, forces are
+in N and torques in N m. Coils are parse_coil / slice_coil arrays in cm, scaled to m.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+# The constant the notebook multiplies the dipole field with. Note mu_0 / 4pi would be
+# 1e-7; this is kept so the magnet strength m means the same as in the notebook.
+NOTEBOOK_DIPOLE_FACTOR = 1e-7 / 4 * np.pi
+
+# Coils are stored in cm, the force model works in m
+CM = 0.01
+
+
+class DipoleRingMagnet:
+    """
+    Cylindrical magnet, axis along z, centred on the origin and magnetised along +z.
+
+    m: Magnetic moment of the whole magnet
+    l: Length of the magnet (along z)
+    d: Diameter of the magnet
+    n_angles: Number of dipoles on each of the two rings (36 = every 10 degrees)
+    shrink: Factor applied to l and d to place the rings inside the magnet
+    factor: Constant in front of the dipole field, see NOTEBOOK_DIPOLE_FACTOR
+    """
+
+    def __init__(
+        self,
+        m=0.185,
+        l=0.003,
+        d=0.006,
+        n_angles=36,
+        shrink=0.75,
+        factor=NOTEBOOK_DIPOLE_FACTOR,
+    ):
+        self.m = m
+        self.l = l
+        self.d = d
+        self.n_angles = n_angles
+        self.shrink = shrink
+        self.factor = factor
+
+    @property
+    def dipoles(self):
+        """
+        (2 * n_angles, 3) positions of the dipoles, in the order the notebook sums them.
+        """
+        angle = np.deg2rad(np.arange(self.n_angles) * 360 / self.n_angles)
+        radius = self.d * self.shrink / 2
+        ring = np.column_stack((-radius * np.cos(angle), -radius * np.sin(angle)))
+        half = self.l * self.shrink / 2
+        positions = np.empty((self.n_angles, 2, 3))
+        positions[:, :, :2] = ring[:, None, :]
+        positions[:, 0, 2] = half
+        positions[:, 1, 2] = -half
+        return positions.reshape(-1, 3)
+
+    def field(self, points):
+        """
+        Returns the (P, 3) field at (P, 3) points.
+
+        Loops over the dipoles (72 by default) with every point at once, which keeps the
+        temporaries at the size of the points.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        px, py, pz = (np.ascontiguousarray(points[:, i]) for i in range(3))
+        Bx, By, Bz = (np.zeros(len(points)) for _ in range(3))
+        for dx, dy, dz in self.dipoles:
+            x, y, z = px - dx, py - dy, pz - dz
+            inv_r2 = 1 / (x * x + y * y + z * z)
+            inv_r3 = inv_r2 * np.sqrt(inv_r2)
+            # 3 z / r^5
+            t = 3 * z * inv_r3 * inv_r2
+            Bx += x * t
+            By += y * t
+            Bz += z * t - inv_r3
+        return np.column_stack((Bx, By, Bz)) * (self.m / self.n_angles * self.factor)
+
+    def vector_potential(self, points):
+        """
+        Returns the (P, 3) vector potential at (P, 3) points, the A = m x r / r^3 of
+        each dipole with the same constant as field (so field is its curl), in T m.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        px, py, pz = (np.ascontiguousarray(points[:, i]) for i in range(3))
+        Ax, Ay = np.zeros(len(points)), np.zeros(len(points))
+        for dx, dy, dz in self.dipoles:
+            x, y, z = px - dx, py - dy, pz - dz
+            inv_r2 = 1 / (x * x + y * y + z * z)
+            inv_r3 = inv_r2 * np.sqrt(inv_r2)
+            Ax -= y * inv_r3
+            Ay += x * inv_r3
+        A = np.zeros((len(points), 3))
+        A[:, 0], A[:, 1] = Ax, Ay
+        return A * (self.m / self.n_angles * self.factor)
+
+
+class MagnetFieldTable:
+    """
+    A magnet's field tabulated on a cylindrically symmetric (r, z) grid and looked up by
+    bilinear interpolation, as a fast stand-in for the magnet (with the same field
+    method).
+
+    The table holds the field averaged around the axis, i.e. the field of the magnet
+    with its rings of dipoles smeared into continuous rings. Points outside the table
+    are evaluated with the magnet directly.
+
+    magnet: Magnet model to tabulate, e.g. DipoleRingMagnet
+    r_max: Radius the table covers
+    z_range: (z_min, z_max) the table covers
+    spacing: Grid spacing in r and z
+    azimuth_samples: Number of angles per dipole spacing the field is averaged over
+    error_samples: Number of random points the table is checked against the magnet on
+    cache_dir: Folder to keep tables in across sessions (None to always compute it)
+
+    After construction error holds the measured accuracy: "max_error" (T) and
+    "max_relative_error" (relative to the largest field in the sample), over
+    error_samples random points of the table outside the magnet's body, against
+    magnet.field.
+    """
+
+    def __init__(
+        self,
+        magnet,
+        r_max=0.04,
+        z_range=(-0.01, 0.01),
+        spacing=5e-5,
+        azimuth_samples=8,
+        error_samples=2000,
+        cache_dir=None,
+    ):
+        self.magnet = magnet
+        self.r = np.linspace(0, r_max, int(round(r_max / spacing)) + 1)
+        self.z = np.linspace(
+            z_range[0], z_range[1], int(round((z_range[1] - z_range[0]) / spacing)) + 1
+        )
+        self.azimuth_samples = azimuth_samples
+        self.error_samples = error_samples
+
+        cache_filename = None
+        if cache_dir is not None:
+            cache_filename = os.path.join(
+                cache_dir, "magnet-{}.npz".format(self._cache_key())
+            )
+            if os.path.exists(cache_filename):
+                with np.load(cache_filename) as cached:
+                    self.table = cached["table"]
+                    self.error = {
+                        "max_error": float(cached["max_error"]),
+                        "max_relative_error": float(cached["max_relative_error"]),
+                    }
+                return
+
+        self.table = self._tabulate()
+        self.error = self._measure_error()
+        if cache_filename is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_filename, table=self.table, **self.error)
+
+    def _cache_key(self):
+        """
+        Hash of the magnet geometry and the grid.
+        """
+        magnet = self.magnet
+        parameters = (
+            type(magnet).__name__,
+            sorted(vars(magnet).items()),
+            self.r[-1],
+            self.z[0],
+            self.z[-1],
+            len(self.r),
+            len(self.z),
+            self.azimuth_samples,
+            self.error_samples,
+        )
+        return hashlib.sha256(repr(parameters).encode()).hexdigest()[:16]
+
+    def _tabulate(self):
+        """
+        Returns the (nr, nz, 2) table of (Br, Bz), averaged over azimuth_samples angles
+        spread over one dipole spacing of the magnet.
+        """
+        R, Z = np.meshgrid(self.r, self.z, indexing="ij")
+        period = 2 * np.pi / getattr(self.magnet, "n_angles", 1)
+        table = np.zeros(R.shape + (2,))
+        for phi in (
+            (np.arange(self.azimuth_samples) + 0.5) * period / self.azimuth_samples
+        ):
+            c, s = np.cos(phi), np.sin(phi)
+            points = np.column_stack((R.ravel() * c, R.ravel() * s, Z.ravel()))
+            B = self.magnet.field(points)
+            table[..., 0] += (B[:, 0] * c + B[:, 1] * s).reshape(R.shape)
+            table[..., 1] += B[:, 2].reshape(R.shape)
+        return table / self.azimuth_samples
+
+    def _measure_error(self):
+        """
+        Compares the table with the magnet on random points outside the magnet's body.
+        """
+        rng = np.random.default_rng(0)
+        radius = getattr(self.magnet, "d", 0) / 2
+        half = getattr(self.magnet, "l", 0) / 2
+        r = np.sqrt(rng.uniform(0, self.r[-1] ** 2, 4 * self.error_samples))
+        z = rng.uniform(self.z[0], self.z[-1], 4 * self.error_samples)
+        outside = (r > radius) | (np.abs(z) > half)
+        r, z = r[outside][: self.error_samples], z[outside][: self.error_samples]
+        phi = rng.uniform(0, 2 * np.pi, len(r))
+        points = np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+        direct = self.magnet.field(points)
+        error = np.sqrt(np.sum((self.field(points) - direct) ** 2, axis=1))
+        return {
+            "max_error": float(np.max(error)),
+            "max_relative_error": float(
+                np.max(error) / np.max(np.sqrt(np.sum(direct**2, axis=1)))
+            ),
+        }
+
+    def field(self, points):
+        """
+        Returns the (P, 3) field at (P, 3) points.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        r = np.sqrt(points[:, 0] ** 2 + points[:, 1] ** 2)
+        u = r / (self.r[1] - self.r[0])
+        v = (points[:, 2] - self.z[0]) / (self.z[1] - self.z[0])
+        inside = (u <= len(self.r) - 1) & (v >= 0) & (v <= len(self.z) - 1)
+
+        i = np.minimum(u.astype(int), len(self.r) - 2)
+        j = np.clip(np.floor(v).astype(int), 0, len(self.z) - 2)
+        fu, fv = (u - i)[:, None], (v - j)[:, None]
+        i, j = np.where(inside, i, 0), np.where(inside, j, 0)
+        table = self.table
+        BrBz = (
+            table[i, j] * (1 - fu) * (1 - fv)
+            + table[i + 1, j] * fu * (1 - fv)
+            + table[i, j + 1] * (1 - fu) * fv
+            + table[i + 1, j + 1] * fu * fv
+        )
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cos, sin = points[:, 0] / r, points[:, 1] / r
+        cos[r == 0], sin[r == 0] = 0, 0
+        B = np.column_stack((BrBz[:, 0] * cos, BrBz[:, 0] * sin, BrBz[:, 1]))
+        if not np.all(inside):
+            B[~inside] = self.magnet.field(points[~inside])
+        return B
+
+    def vector_potential(self, points):
+        """
+        Only the field is tabulated, the vector potential comes from the magnet itself.
+        """
+        return self.magnet.vector_potential(points)
+
+
+def coil_segments(coil, position=(0, 0, 0), scale=CM):
+    """
+    Turns a (4, N) coil into segments in m.
+
+    position: (x, y, z) in m the coil's origin is moved to
+    scale: Size of the coil's length unit in m
+
+    Returns (starts (K, 3), ends (K, 3), currents (K,)).
+    """
+    coil = np.asarray(coil, dtype=float)
+    vertices = coil[:3].T * scale + np.asarray(position, dtype=float)
+    return vertices[:-1], vertices[1:], coil[3, :-1]
+
+
+def segment_forces(coil, magnet, position=(0, 0, 0), scale=CM, evaluate_at="midpoint"):
+    """
+    Force of the magnet on every segment of a coil, F = I dl x B.
+
+    coil: (4, N) coil, already sliced into short pieces with slice_coil
+    magnet: Magnet model with a field(points) method, e.g. DipoleRingMagnet
+    position, scale: Where the coil is, see coil_segments
+    evaluate_at: "midpoint" or "start" of each segment, the notebook uses the start
+
+    Returns (points (K, 3), forces (K, 3)), with the points the field was evaluated at.
+
+    The notebook's calculate_forces_on_wire_points points dl against the current, so its
+    forces are -segment_forces(..., evaluate_at="start").
+    """
+    starts, ends, currents = coil_segments(coil, position, scale)
+    if evaluate_at == "midpoint":
+        points = (starts + ends) / 2
+    elif evaluate_at == "start":
+        points = starts
+    else:
+        raise ValueError(
+            "evaluate_at must be 'midpoint' or 'start', got {!r}".format(evaluate_at)
+        )
+    forces = currents[:, None] * np.cross(ends - starts, magnet.field(points))
+    return points, forces
+
+
+def coil_force_torque(
+    coil, magnet, position=(0, 0, 0), scale=CM, center=(0, 0, 0), evaluate_at="midpoint"
+):
+    """
+    Total force and torque of the magnet on a coil.
+
+    center: (x, y, z) in m the torque is taken about, e.g. the rotor axis
+
+    Returns (force (3,), torque (3,)).
+    """
+    points, forces = segment_forces(coil, magnet, position, scale, evaluate_at)
+    torque = np.cross(points - np.asarray(center, dtype=float), forces)
+    return forces.sum(axis=0), torque.sum(axis=0)
@@ -0,0 +1,258 @@
+"""
+Adaptive octree target volumes.
+
+A uniform target volume either wastes evaluations in empty space or under-resolves the
+field next to the copper. Here the box starts as a grid of coarse cells; a cell is split
+into 8 children wherever trilinear interpolation from its corners misses the field at
+its centre by more than a tolerance, down to max_level splits.
+
+The field is stored only at the corners of the cells (shared between neighbours) and is
+queried by trilinear interpolation inside the leaf that holds a point. to_grid resamples
+it onto a regular grid for plot_fields.
+
+All lengths are in cm, B-field is in G
+"""
+
+import numpy as np
+
+from biot_savart_v4_3 import calculate_field, flatten_points, volume_axes
+
+# Corner offsets of a cell, in units of the cell size
+CORNERS = np.array(list(np.ndindex(2, 2, 2)))
+
+
+class AdaptiveVolume:
+    """
+    Field samples on the corners of the leaves of an octree.
+
+    Positions are kept as integer coordinates on the lattice of the finest level, with
+    spacing coarse_resolution / 2^max_level, starting at start_point.
+
+    start_point: (x, y, z) corner of the box in cm
+    coarse_resolution: Size of the cells before any refinement
+    max_level: Number of times a cell may be split
+    cells: Number of coarse cells along each axis
+    """
+
+    def __init__(self, start_point, coarse_resolution, max_level, cells):
+        self.start_point = np.asarray(start_point, dtype=float)
+        self.coarse_resolution = coarse_resolution
+        self.max_level = max_level
+        self.cells = np.asarray(cells)
+        # number of lattice points along each axis
+        self.lattice = self.cells * 2**max_level + 1
+        self.sample_keys = np.zeros(0, dtype=np.int64)
+        self.sample_values = np.zeros((0, 3))
+        self.leaf_keys = [np.zeros(0, dtype=np.int64) for _ in range(max_level + 1)]
+
+    @property
+    def spacing(self):
+        """
+        Distance between lattice points of the finest level (in cm).
+        """
+        return self.coarse_resolution / 2**self.max_level
+
+    @property
+    def box_size(self):
+        """
+        (x, y, z) dimensions of the box covered by the coarse cells (in cm).
+        """
+        return tuple(self.cells * self.coarse_resolution)
+
+    def cell_size(self, level):
+        """
+        Size of the cells of a level in lattice units.
+        """
+        return 2 ** (self.max_level - level)
+
+    def encode(self, lattice_points):
+        """
+        Packs (N, 3) integer lattice coordinates into single int64 keys.
+        """
+        lattice_points = np.asarray(lattice_points, dtype=np.int64)
+        return (
+            lattice_points[..., 0] * self.lattice[1] + lattice_points[..., 1]
+        ) * self.lattice[2] + lattice_points[..., 2]
+
+    def decode(self, keys):
+        """
+        Unpacks int64 keys into (N, 3) integer lattice coordinates.
+        """
+        k = keys % self.lattice[2]
+        j = (keys // self.lattice[2]) % self.lattice[1]
+        i = keys // (self.lattice[2] * self.lattice[1])
+        return np.stack((i, j, k), axis=-1)
+
+    def positions(self, lattice_points):
+        """
+        Converts integer lattice coordinates into positions in cm.
+        """
+        return self.start_point + np.asarray(lattice_points) * self.spacing
+
+    def add_samples(self, keys, values):
+        """
+        Stores the field values of new lattice points.
+        """
+        keys = np.concatenate((self.sample_keys, keys))
+        values = np.concatenate((self.sample_values, values))
+        order = np.argsort(keys, kind="stable")
+        self.sample_keys, self.sample_values = keys[order], values[order]
+
+    def missing_samples(self, keys):
+        """
+        Returns the unique keys that have no field value yet.
+        """
+        keys = np.unique(keys)
+        return keys[~np.isin(keys, self.sample_keys)]
+
+    def samples(self, keys):
+        """
+        Looks up the stored field values of existing lattice points.
+        """
+        return self.sample_values[np.searchsorted(self.sample_keys, keys)]
+
+    def add_leaves(self, level, origins):
+        """
+        Marks the cells of a level with the given lattice origins as leaves.
+        """
+        self.leaf_keys[level] = np.sort(
+            np.concatenate((self.leaf_keys[level], self.encode(origins)))
+        )
+
+    @property
+    def n_samples(self):
+        """
+        Number of points the field was evaluated at.
+        """
+        return len(self.sample_keys)
+
+    @property
+    def n_uniform_samples(self):
+        """
+        Number of points a uniform grid at the finest resolution would need.
+        """
+        return int(np.prod(self.lattice))
+
+    def query(self, points):
+        """
+        Interpolates the field at (P, 3) positions in cm. Returns a (P, 3) array, NaN
+        outside of the box.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        u = (points - self.start_point) / self.spacing
+        inside = np.all((u > -1e-9) & (u < self.lattice - 1 + 1e-9), axis=1)
+        u = np.clip(u, 0, self.lattice - 1)
+
+        B = np.full((len(points), 3), np.nan)
+        todo = np.flatnonzero(inside)
+        for level in range(self.max_level, -1, -1):
+            if not len(todo) or not len(self.leaf_keys[level]):
+                continue
+            size = self.cell_size(level)
+            # origin of this level's cell holding each point (the last cell on far faces)
+            origin = np.minimum(
+                np.floor(u[todo] / size).astype(np.int64) * size,
+                self.lattice - 1 - size,
+            )
+            keys = self.encode(origin)
+            index = np.minimum(
+                np.searchsorted(self.leaf_keys[level], keys),
+                len(self.leaf_keys[level]) - 1,
+            )
+            found = self.leaf_keys[level][index] == keys
+            if not np.any(found):
+                continue
+
+            cells = todo[found]
+            fraction = (u[cells] - origin[found]) / size
+            values = np.zeros((len(cells), 3))
+            for corner in CORNERS:
+                weight = np.prod(np.where(corner, fraction, 1 - fraction), axis=1)
+                values += weight[:, None] * self.samples(
+                    self.encode(origin[found] + corner * size)
+                )
+            B[cells] = values
+            todo = todo[~found]
+        return B
+
+    def to_grid(self, box_size, start_point, vol_resolution):
+        """
+        Resamples the field onto a regular grid, in the same layout as
+        produce_target_volume, e.g. for plot_fields.
+        """
+        x, y, z = volume_axes(box_size, start_point, vol_resolution)
+        Z, Y, X = np.meshgrid(z, y, x, indexing="ij")
+        points, shape = flatten_points(X, Y, Z)
+        return self.query(points).reshape(shape + (3,))
+
+
+def produce_adaptive_volume(
+    coil,
+    box_size,
+    start_point,
+    coarse_resolution,
+    max_level=3,
+    tolerance=0.01,
+    relative_tolerance=0,
+    **field_options,
+):
+    """
+    Generates an adaptively refined target volume.
+
+    Coil: Input Coil Positions, prepared as for produce_target_volume
+    box_size: (x, y, z) dimensions of the box in cm, rounded up to whole coarse cells
+    start_point: (x, y, z) = (0, 0, 0) = bottom left corner position of the box
+    coarse_resolution: Size of the cells before any refinement (in cm)
+    max_level: Number of times a cell may be split, the finest spacing is
+    coarse_resolution / 2^max_level
+    tolerance: A cell is split when interpolating from its corners misses the field at
+    its centre by more than tolerance + relative_tolerance * |B| (in G)
+    field_options: Extra keyword arguments passed on to calculate_field
+
+    Returns an AdaptiveVolume.
+    """
+    cells = np.maximum(
+        np.ceil(np.asarray(box_size) / coarse_resolution - 1e-9).astype(int), 1
+    )
+    volume = AdaptiveVolume(start_point, coarse_resolution, max_level, cells)
+
+    def evaluate(lattice_points):
+        keys = volume.missing_samples(volume.encode(lattice_points).ravel())
+        if len(keys):
+            positions = volume.positions(volume.decode(keys))
+            values = calculate_field(
+                coil, positions[:, 0], positions[:, 1], positions[:, 2], **field_options
+            )
+            volume.add_samples(keys, values)
+
+    origins = np.stack(
+        np.meshgrid(*[np.arange(n) for n in cells], indexing="ij"), axis=-1
+    ).reshape(-1, 3) * volume.cell_size(0)
+
+    for level in range(max_level + 1):
+        size = volume.cell_size(level)
+        corners = origins[:, None, :] + CORNERS[None, :, :] * size
+        evaluate(corners)
+        if level == max_level:
+            volume.add_leaves(level, origins)
+            break
+
+        # compare the field at the cell centres with the trilinear guess (corner average)
+        centres = origins + size // 2
+        evaluate(centres)
+        centre_field = volume.samples(volume.encode(centres))
+        guess = np.mean(volume.samples(volume.encode(corners)), axis=1)
+        error = np.sqrt(np.sum((centre_field - guess) ** 2, axis=1))
+        limit = tolerance + relative_tolerance * np.sqrt(
+            np.sum(centre_field**2, axis=1)
+        )
+        refine = error > limit
+
+        volume.add_leaves(level, origins[~refine])
+        origins = (
+            origins[refine][:, None, :] + CORNERS[None, :, :] * (size // 2)
+        ).reshape(-1, 3)
+        if not len(origins):
+            break
+
+    return volume
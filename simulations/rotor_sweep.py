@@ -0,0 +1,213 @@
+"""
+Force and torque curves of coils swept past a magnet.
+
+Replaces sweep_coil_circle in magnetic_force_on_coils.ipynb: the coil moves around a
+circle of the given radius centred on (0, -radius), with the magnet at the origin, and
+the force on it is recorded at every angle. The coils are scaled to m once and placed in
+shared memory; the angles are handed out to the worker processes in chunks, and every
+chunk is evaluated as one array operation over all of its angles and segments.
+
+Lengths are in m, forces in N and torques in N m, angles in degrees, coils in cm.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from biot_savart_v4_3 import DEFAULT_MEMORY_BUDGET, POOL_START_METHOD
+from magnet import CM, coil_segments
+
+# Radius and height of the notebook's sweep, in m
+NOTEBOOK_SWEEP_RADIUS = 20.5 / 1000
+NOTEBOOK_SWEEP_Z = -0.0025
+
+# Rough number of bytes of temporaries per (angle, segment) pair of a chunk
+BYTES_PER_SWEEP_POINT = 8 * 16
+
+
+def sweep_positions(theta, radius=NOTEBOOK_SWEEP_RADIUS, z=NOTEBOOK_SWEEP_Z):
+    """
+    Returns the (A, 3) positions the coil origin is moved to for each angle theta.
+    """
+    theta = np.deg2rad(np.asarray(theta, dtype=float))
+    return np.column_stack(
+        (
+            radius * np.cos(theta),
+            radius * np.sin(theta) - radius,
+            np.full(len(theta), float(z)),
+        )
+    )
+
+
+def pack_coils(coils, scale=CM, evaluate_at="midpoint", relative_currents=False):
+    """
+    Scales every coil to m once and packs the segments of all of them into one array, so
+    a chunk of positions can be evaluated against every coil in one array operation.
+
+    coils: Dict of {name: (4, N) coil} (or a list, named 0, 1, ...)
+    evaluate_at: "midpoint" or "start" of each segment, see magnet.segment_forces
+    relative_currents: Scale the currents of each coil so the largest is 1, leaving only
+    the direction of the track (raises ValueError for a coil that carries no current)
+
+    Returns (coils as a dict, segments (K, 7) with the evaluation point (3), dl (3) and
+    current of every segment, bounds with the index of the first segment of every coil
+    and the total).
+    """
+    if not isinstance(coils, dict):
+        coils = dict(enumerate(coils))
+    if evaluate_at not in ("midpoint", "start"):
+        raise ValueError(
+            "evaluate_at must be 'midpoint' or 'start', got {!r}".format(evaluate_at)
+        )
+
+    blocks = []
+    for name, coil in coils.items():
+        starts, ends, currents = coil_segments(coil, scale=scale)
+        if relative_currents:
+            largest = np.max(np.abs(currents), initial=0)
+            if largest == 0:
+                raise ValueError("coil {!r} carries no current".format(name))
+            currents = currents / largest
+        points = (starts + ends) / 2 if evaluate_at == "midpoint" else starts
+        blocks.append(np.column_stack((points, ends - starts, currents)))
+    bounds = np.cumsum([0] + [len(block) for block in blocks])
+    return coils, np.concatenate(blocks), bounds
+
+
+def sum_per_coil(per_segment, bounds):
+    """
+    Adds up an (A, K, ...) array of per segment values into (A, n_coils, ...) per coil
+    totals, with bounds from pack_coils.
+    """
+    return np.add.reduceat(per_segment, bounds[:-1], axis=1)
+
+
+def _sweep_chunk(segments, bounds, magnet, positions, center):
+    """
+    Forces and torques on every coil at a chunk of positions.
+
+    segments, bounds: The coils packed by pack_coils
+    positions: (A, 3) positions of the coil origin
+
+    Returns an (A, n_coils, 4) array of Fx, Fy, Fz and the torque about the z axis
+    through center.
+    """
+    points = segments[None, :, :3] + positions[:, None, :]
+    B = magnet.field(points.reshape(-1, 3)).reshape(points.shape)
+    forces = segments[None, :, 6, None] * np.cross(segments[None, :, 3:6], B)
+    arm = points - center
+    torque = arm[..., 0] * forces[..., 1] - arm[..., 1] * forces[..., 0]
+    per_segment = np.concatenate((forces, torque[..., None]), axis=2)
+    return sum_per_coil(per_segment, bounds)
+
+
+# state of a sweep worker process, set up once by _init_sweep_worker
+_sweep_worker = {}
+
+
+def _init_sweep_worker(shm_name, shape, bounds, magnet, center):
+    """
+    Attaches a worker process to the shared segment array, so the coils and the magnet
+    are only sent to each worker once.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _sweep_worker.update(
+        shm=shm,
+        segments=np.ndarray(shape, dtype=float, buffer=shm.buf),
+        bounds=bounds,
+        magnet=magnet,
+        center=center,
+    )
+
+
+def _sweep_worker_chunk(positions):
+    """
+    Evaluates one chunk of positions against the shared segments.
+    """
+    return _sweep_chunk(
+        _sweep_worker["segments"],
+        _sweep_worker["bounds"],
+        _sweep_worker["magnet"],
+        positions,
+        _sweep_worker["center"],
+    )
+
+
+def sweep_coils(
+    coils,
+    magnet,
+    theta,
+    radius=NOTEBOOK_SWEEP_RADIUS,
+    z=NOTEBOOK_SWEEP_Z,
+    scale=CM,
+    evaluate_at="midpoint",
+    workers=1,
+    chunk_size=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+):
+    """
+    Sweeps one or more coils around the circle and records the force and torque on each.
+
+    coils: Dict of {name: (4, N) coil} (or a list, named 0, 1, ...), sliced with
+    slice_coil
+    magnet: Magnet model with a field(points) method, e.g. magnet.DipoleRingMagnet
+    theta: Angles to evaluate, in degrees
+    radius, z: The circle, see sweep_positions
+    scale: Size of the coils' length unit in m
+    evaluate_at: "midpoint" or "start" of each segment, see magnet.segment_forces
+    workers: Number of processes, None uses every CPU core. They are spawned, see
+    produce_target_volume.
+    chunk_size: Number of angles per chunk, defaults to what fits memory_budget
+
+    Returns {name: {"Fx", "Fy", "Fz", "torque"}} with an array of len(theta) for each.
+    The torque is about the z axis through the centre of the circle.
+    """
+    coils, segments, bounds = pack_coils(coils, scale, evaluate_at)
+    positions = sweep_positions(theta, radius, z)
+    center = np.array([0, -radius, 0.0])
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(
+            1, int(memory_budget) // (BYTES_PER_SWEEP_POINT * len(segments))
+        )
+        if workers > 1:
+            # keep every worker busy with a few chunks each
+            chunk_size = min(chunk_size, -(-len(positions) // (4 * workers)))
+    chunks = [
+        positions[a : a + chunk_size] for a in range(0, len(positions), chunk_size)
+    ]
+
+    if workers <= 1:
+        results = [
+            _sweep_chunk(segments, bounds, magnet, chunk, center) for chunk in chunks
+        ]
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=segments.nbytes)
+        try:
+            np.ndarray(segments.shape, dtype=float, buffer=shm.buf)[:] = segments
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(chunks)),
+                mp_context=multiprocessing.get_context(POOL_START_METHOD),
+                initializer=_init_sweep_worker,
+                initargs=(shm.name, segments.shape, bounds, magnet, center),
+            ) as pool:
+                results = list(pool.map(_sweep_worker_chunk, chunks))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    curves = np.concatenate(results) if results else np.zeros((0, len(coils), 4))
+    return {
+        name: {
+            "Fx": curves[:, i, 0],
+            "Fy": curves[:, i, 1],
+            "Fz": curves[:, i, 2],
+            "torque": curves[:, i, 3],
+        }
+        for i, name in enumerate(coils)
+    }
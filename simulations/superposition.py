@@ -0,0 +1,195 @@
+"""
+Unit-current field basis and superposition.
+
+The magnetic field is linear in the current, so the field of a coil (or a group of coils
+wired into the same phase) only has to be computed once for 1 A. The field for any set
+of currents, or a whole series of commutation steps, is then a weighted sum of the
+cached volumes and never touches the Biot-Savart kernel again.
+
+All lengths are in cm, B-field is in G, currents are in A
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+from biot_savart_v4_3 import parse_coil, produce_target_volume, slice_coil
+
+# Phase currents (A, B, C) of the six steps of trapezoidal (block) commutation
+SIX_STEP_COMMUTATION = np.array(
+    [
+        [1, -1, 0],
+        [1, 0, -1],
+        [0, 1, -1],
+        [-1, 1, 0],
+        [-1, 0, 1],
+        [0, -1, 1],
+    ]
+)
+
+
+def unit_current_coil(coil):
+    """
+    Scales the currents of a coil so the largest one is 1 A, keeping the direction (and
+    any variation) of the current along the coil.
+    """
+    coil = np.array(coil, dtype=float)
+    nominal = np.max(np.abs(coil[3]))
+    if nominal == 0:
+        raise ValueError("coil carries no current")
+    coil[3] /= nominal
+    return coil
+
+
+def commutation_table(current, steps=SIX_STEP_COMMUTATION):
+    """
+    Returns the (steps, phases) table of phase currents for a commutation sequence, e.g.
+    to pass to FieldBasis.series. Defaults to six-step commutation of phases A, B, C.
+
+    current: Current in amperes flowing through the energised phases
+    """
+    return current * np.asarray(steps, dtype=float)
+
+
+class FieldBasis:
+    """
+    A set of unit-current target volumes, one per coil group (e.g. per phase A, B, C).
+
+    box_size, start_point, vol_resolution: The target volume, as for
+    produce_target_volume
+    coil_resolution: Length the coils are sliced into before integrating (None to use
+    them as is, e.g. with method="segment")
+    cache_dir: Folder to keep the computed volumes in across sessions (None to only keep
+    them in memory)
+    field_options: Extra keyword arguments passed on to produce_target_volume (e.g.
+    method, workers)
+    """
+
+    def __init__(
+        self,
+        box_size,
+        start_point,
+        vol_resolution,
+        coil_resolution=1,
+        cache_dir=None,
+        **field_options,
+    ):
+        self.box_size = tuple(box_size)
+        self.start_point = tuple(start_point)
+        self.vol_resolution = vol_resolution
+        self.coil_resolution = coil_resolution
+        self.cache_dir = cache_dir
+        self.field_options = field_options
+        self.volumes = {}
+
+    @property
+    def names(self):
+        """
+        The names of the coil groups, in the order they were added.
+        """
+        return list(self.volumes)
+
+    def add(self, name, *coils):
+        """
+        Adds (or replaces) the coil group name, made of the given coils wired in series.
+
+        coils: Coil file names or (4, N) coil arrays. Each coil is scaled to 1 A with
+        unit_current_coil, so the group's current direction comes from the files.
+
+        Returns the unit-current volume of the group.
+        """
+        coils = [
+            unit_current_coil(parse_coil(c) if isinstance(c, (str, os.PathLike)) else c)
+            for c in coils
+        ]
+        cache_filename = None
+        if self.cache_dir is not None:
+            cache_filename = os.path.join(
+                self.cache_dir, "{}-{}.npy".format(name, self._cache_key(coils))
+            )
+            if os.path.exists(cache_filename):
+                self.volumes[name] = np.load(cache_filename)
+                return self.volumes[name]
+
+        volume = 0
+        for coil in coils:
+            if self.coil_resolution is not None:
+                coil = slice_coil(coil, self.coil_resolution)
+            volume = volume + produce_target_volume(
+                coil,
+                self.box_size,
+                self.start_point,
+                self.vol_resolution,
+                **self.field_options,
+            )
+        self.volumes[name] = volume
+
+        if cache_filename is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(cache_filename, volume)
+        return volume
+
+    def _cache_key(self, coils):
+        """
+        Hash of everything the volume of a group depends on.
+        """
+        h = hashlib.sha256()
+        for coil in coils:
+            h.update(np.ascontiguousarray(coil).tobytes())
+        h.update(
+            repr(
+                (
+                    self.box_size,
+                    self.start_point,
+                    self.vol_resolution,
+                    self.coil_resolution,
+                    sorted(self.field_options.items()),
+                )
+            ).encode()
+        )
+        return h.hexdigest()[:16]
+
+    def _weights(self, currents):
+        """
+        Turns currents given as a dict {name: amps} or a sequence in group order into
+        an array.
+        """
+        if isinstance(currents, dict):
+            unknown = set(currents) - set(self.volumes)
+            if unknown:
+                raise KeyError("unknown coil groups: {}".format(sorted(unknown)))
+            return np.array([currents.get(name, 0.0) for name in self.volumes])
+        currents = np.asarray(currents, dtype=float)
+        if currents.shape[-1] != len(self.volumes):
+            raise ValueError(
+                "expected {} currents, got {}".format(
+                    len(self.volumes), currents.shape[-1]
+                )
+            )
+        return currents
+
+    def field(self, currents):
+        """
+        Returns the target volume for the given currents (dict {name: amps} or a
+        sequence in the order of names), as a weighted sum of the unit-current volumes.
+        """
+        weights = self._weights(currents)
+        total = np.zeros_like(next(iter(self.volumes.values())))
+        for weight, volume in zip(weights, self.volumes.values()):
+            if weight != 0:
+                total += weight * volume
+        return total
+
+    def series(self, currents):
+        """
+        Returns the target volumes for a series of current settings, e.g. the steps of a
+        commutation sequence (see commutation_table).
+
+        currents: (T, groups) array of currents, columns in the order of names
+
+        Output is a (T, nx, ny, nz, 3) array.
+        """
+        weights = np.atleast_2d(self._weights(currents))
+        basis = np.stack(list(self.volumes.values()))
+        return np.tensordot(weights, basis, axes=(1, 0))
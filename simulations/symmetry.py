@@ -0,0 +1,185 @@
+"""
+Stator fields from one coil and a symmetry group.
+
+The stators in the generator notebooks are N copies of one coil, rotated by 360 / N
+around the stator centre, moved out to the coil radius and sometimes mirrored with
+flip_y first. Instead of integrating every copy, the field of the base coil is computed
+once and each copy's field is resampled from it:
+
+    B_copy(q) = det(L) L B_base(L^-1 (q - t))
+
+where L is the rotation (and mirror) of the copy and t its offset; det(L) flips the sign
+for mirrored copies because B is a pseudovector. Points where the resampling error of
+the base volume is too large (next to the copper) are evaluated directly instead.
+
+All lengths are in cm, B-field is in G, angles are in degrees
+"""
+
+import numpy as np
+
+from biot_savart_v4_3 import (
+    calculate_field,
+    flatten_points,
+    interpolate_field,
+    produce_target_volume,
+    volume_axes,
+)
+
+# Default resampling tolerance, relative to the largest field of the base coil
+DEFAULT_RELATIVE_TOLERANCE = 1e-3
+
+
+def placement_transform(angle, radius=0, flip_y=False):
+    """
+    Returns the (3, 3) matrix L and offset t that place a coil like the generator
+    notebooks do: translate(rotate(flip_y(points), angle), radius, angle), i.e.
+    p -> L p + t.
+    """
+    c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+    L = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+    if flip_y:
+        L = L @ np.diag([1, -1, 1])
+    return L, np.array([radius * c, radius * s, 0])
+
+
+def place_coil(coil, angle, radius=0, flip_y=False):
+    """
+    Returns a copy of a (4, N) coil placed with placement_transform.
+    """
+    L, t = placement_transform(angle, radius, flip_y)
+    placed = np.array(coil, dtype=float)
+    placed[:3] = L @ placed[:3] + t[:, None]
+    return placed
+
+
+def stator_placements(n_coils, radius, rotation=0, flipped=()):
+    """
+    Returns the placements (angle, radius, flip_y) of the coils of a stator.
+
+    n_coils: Number of coils, spaced by 360 / n_coils
+    radius: Distance of the coil centres from the stator centre
+    rotation: Angle of the first coil
+    flipped: Indices of the coils that are mirrored with flip_y, e.g. for the 12 coil
+    stator [i for i in range(12) if (i // 3) % 2 == 1]
+    """
+    return [
+        (i * 360 / n_coils + rotation, radius, i in set(flipped))
+        for i in range(n_coils)
+    ]
+
+
+def resampling_error(targetVolume):
+    """
+    Estimates the error of trilinear interpolation in every cell of a target volume from
+    the second differences of the field along each axis (h^2 f'' / 8).
+
+    Returns a volume of shape (nx, ny, nz) in G.
+    """
+    error = np.zeros(targetVolume.shape[:3])
+    for axis in range(3):
+        if targetVolume.shape[axis] < 3:
+            continue
+        second = np.abs(np.diff(targetVolume, n=2, axis=axis)).max(axis=-1) / 8
+        # a cell's error is set by the curvature at both of its ends
+        inner = [slice(None)] * 3
+        inner[axis] = slice(1, -1)
+        padded = np.zeros(targetVolume.shape[:3])
+        padded[tuple(inner)] = second
+        shifted = [slice(None)] * 3
+        shifted[axis] = slice(0, -1)
+        following = [slice(None)] * 3
+        following[axis] = slice(1, None)
+        padded[tuple(shifted)] = np.maximum(
+            padded[tuple(shifted)], padded[tuple(following)]
+        )
+        error = np.maximum(error, padded)
+    return error
+
+
+def produce_symmetric_volume(
+    coil,
+    placements,
+    box_size,
+    start_point,
+    vol_resolution,
+    tolerance=None,
+    return_report=False,
+    **field_options,
+):
+    """
+    Generates the target volume of a whole stator from one base coil and its placements.
+
+    Coil: The base coil, prepared as for produce_target_volume
+    placements: List of (angle, radius, flip_y), e.g. from stator_placements
+    box_size, start_point, vol_resolution: The target volume, as for
+    produce_target_volume
+    tolerance: Largest acceptable resampling error in G. Points of a copy where the base
+    volume can not be interpolated that accurately are evaluated directly. Defaults to
+    DEFAULT_RELATIVE_TOLERANCE times the largest field of the base coil.
+    return_report: Also return a dict with the number of points evaluated by the kernel
+    field_options: Extra keyword arguments passed on to calculate_field
+
+    The result has the same layout as produce_target_volume.
+    """
+    x, y, z = volume_axes(box_size, start_point, vol_resolution)
+    Z, Y, X = np.meshgrid(z, y, x, indexing="ij")
+    points, shape = flatten_points(X, Y, Z)
+    transforms = [placement_transform(*placement) for placement in placements]
+
+    # the base volume has to hold every target point mapped back onto the base coil
+    corners = np.array(
+        [[x[i], y[j], z[k]] for i in (0, -1) for j in (0, -1) for k in (0, -1)]
+    )
+    mapped = np.concatenate([(corners - t) @ L for L, t in transforms])
+    base_start = np.floor(mapped.min(axis=0) / vol_resolution) * vol_resolution
+    base_start -= vol_resolution
+    base_size = (
+        np.ceil(mapped.max(axis=0) / vol_resolution) * vol_resolution
+        + vol_resolution
+        - base_start
+    )
+    base_start, base_size = tuple(base_start), tuple(base_size)
+
+    base = produce_target_volume(
+        coil, base_size, base_start, vol_resolution, **field_options
+    )
+    error = resampling_error(base)
+    if tolerance is None:
+        tolerance = DEFAULT_RELATIVE_TOLERANCE * np.max(
+            np.sqrt(np.sum(base**2, axis=-1))
+        )
+
+    B = np.zeros((len(points), 3))
+    direct = 0
+    for (L, t), placement in zip(transforms, placements):
+        local = (points - t) @ L
+        # resample the base field and rotate (and mirror) it into place
+        B_copy = (
+            np.linalg.det(L)
+            * interpolate_field(base, local, base_size, base_start, vol_resolution)
+            @ L.T
+        )
+        local_error = interpolate_field(
+            error[..., None], local, base_size, base_start, vol_resolution
+        )[:, 0]
+        fallback = ~(local_error <= tolerance)
+        if np.any(fallback):
+            target = points[fallback]
+            B_copy[fallback] = calculate_field(
+                place_coil(coil, *placement),
+                target[:, 0],
+                target[:, 1],
+                target[:, 2],
+                **field_options,
+            )
+            direct += int(np.sum(fallback))
+        B += B_copy
+
+    targetVolume = B.reshape(shape + (3,))
+    if return_report:
+        return targetVolume, {
+            "points": len(points) * len(placements),
+            "base_points": int(np.prod(base.shape[:3])),
+            "direct_points": direct,
+        }
+    return targetVolume
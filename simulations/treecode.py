@@ -0,0 +1,272 @@
+"""
+Barnes-Hut style tree code for the Biot-Savart sum.
+
+Direct summation costs segments x points. Here the coil segments are sorted into a
+binary tree of clusters; a cluster that is far away from a point (compared to its own
+size) is replaced by a multipole expansion of its current elements, while nearby
+clusters are summed exactly with the straight-segment kernel.
+
+theta sets the accuracy: a cluster of radius r is expanded for points further than
+r / theta away from its centre. Smaller is more accurate, theta = 0 is direct summation.
+
+All lengths are in cm, B-field is in G
+"""
+
+import numpy as np
+
+import instrumentation
+from biot_savart_v4_3 import (
+    BYTES_PER_PAIR,
+    DEFAULT_LEAF_SIZE,
+    DEFAULT_MEMORY_BUDGET,
+    DEFAULT_THETA,
+    _straight_segment_block,
+    calculate_field,
+    flatten_points,
+)
+
+
+def build_tree(starts, ends, currents, leaf_size=DEFAULT_LEAF_SIZE):
+    """
+    Sorts the segments into a binary tree by repeatedly splitting them at the median of
+    their midpoints along the longest side of the bounding box.
+
+    starts, ends: (K, 3) segment end points
+    currents: (K,) current flowing through each segment
+
+    Returns a dict of arrays, with the segments reordered so every node covers the
+    contiguous range first[n]:last[n]:
+        starts, ends, currents - the reordered segments
+        first, last - segment range of each node
+        children - (n, 2) child nodes, -1 for leaves
+        center, radius - sphere around every segment of the node
+        moment - (n, 3) sum of I dl over the node (monopole term)
+        dipole - (n, 3, 3) sum of I dl (outer) d over the node, d = midpoint - center
+        quadrupole - (n, 3, 3, 3) sum of I dl (outer) (d d + dl dl / 12), where the dl
+        dl / 12 part accounts for the current being spread along the segment
+    """
+    mids = (starts + ends) / 2
+    order = np.arange(len(starts))
+    first, last, children = [0], [len(starts)], [[-1, -1]]
+
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        lo, hi = first[node], last[node]
+        if hi - lo <= leaf_size:
+            continue
+        segment = order[lo:hi]
+        extent = np.ptp(mids[segment], axis=0)
+        axis = int(np.argmax(extent))
+        half = (hi - lo) // 2
+        order[lo:hi] = segment[
+            np.argpartition(mids[segment, axis], half, kind="introselect")
+        ]
+        for side, (child_lo, child_hi) in enumerate(((lo, lo + half), (lo + half, hi))):
+            children[node][side] = len(first)
+            stack.append(len(first))
+            first.append(child_lo)
+            last.append(child_hi)
+            children.append([-1, -1])
+
+    starts, ends, currents = starts[order], ends[order], currents[order]
+    mids = mids[order]
+    first, last = np.array(first), np.array(last)
+
+    n_nodes = len(first)
+    center = np.empty((n_nodes, 3))
+    radius = np.empty(n_nodes)
+    moment = np.empty((n_nodes, 3))
+    dipole = np.empty((n_nodes, 3, 3))
+    quadrupole = np.empty((n_nodes, 3, 3, 3))
+    dl = ends - starts
+    current_dl = currents[:, None] * dl
+    for node in range(n_nodes):
+        lo, hi = first[node], last[node]
+        corners = np.concatenate((starts[lo:hi], ends[lo:hi]))
+        center[node] = (corners.min(axis=0) + corners.max(axis=0)) / 2
+        radius[node] = np.sqrt(np.max(np.sum((corners - center[node]) ** 2, axis=1)))
+        moment[node] = np.sum(current_dl[lo:hi], axis=0)
+        d = mids[lo:hi] - center[node]
+        dipole[node] = current_dl[lo:hi].T @ d
+        quadrupole[node] = (
+            np.einsum("ka,kb,kc->abc", current_dl[lo:hi], d, d)
+            + np.einsum("ka,kb,kc->abc", current_dl[lo:hi], dl[lo:hi], dl[lo:hi]) / 12
+        )
+
+    return {
+        "starts": starts,
+        "ends": ends,
+        "currents": currents,
+        "first": first,
+        "last": last,
+        "children": np.array(children),
+        "center": center,
+        "radius": radius,
+        "moment": moment,
+        "dipole": dipole,
+        "quadrupole": quadrupole,
+    }
+
+
+def _epsilon_contract(M):
+    """
+    Returns the (n, 3) vectors e_abc M_bc of a stack of (n, 3, 3) matrices.
+    """
+    return np.stack(
+        (M[:, 1, 2] - M[:, 2, 1], M[:, 2, 0] - M[:, 0, 2], M[:, 0, 1] - M[:, 1, 0]),
+        axis=1,
+    )
+
+
+def _multipole_field(tree, nodes, points):
+    """
+    Field of the given nodes at the given points (one node per point) from the Taylor
+    expansion of R / |R|^3 about the node centre, to quadrupole order (without the
+    mu_0 / 4pi factor).
+
+    With R the vector from the centre to the point, J the moment, Q the dipole and O the
+    quadrupole tensor of the node:
+    B = J x R / R^3
+        - e.Q / R^3 + 3 (Q R) x R / R^5
+        - 3 e.(O R) / R^5 - 3/2 (O:1) x R / R^5 + 15/2 (O R R) x R / R^7
+    where e.M is the vector e_abc M_bc and O:1 is the vector O_abb.
+    """
+    R = points - tree["center"][nodes]
+    r2 = np.sum(R**2, axis=1)
+    r3 = r2 * np.sqrt(r2)
+    r5 = r3 * r2
+    Q = tree["dipole"][nodes]
+    O = tree["quadrupole"][nodes]
+
+    OR = np.einsum("nabc,nc->nab", O, R)
+    ORR = np.einsum("nab,nb->na", OR, R)
+    QR = np.einsum("nab,nb->na", Q, R)
+    trace = np.einsum("nabb->na", O)
+
+    return (
+        (np.cross(tree["moment"][nodes], R) - _epsilon_contract(Q)) / r3[:, None]
+        + (3 * np.cross(QR, R) - 3 * _epsilon_contract(OR) - 1.5 * np.cross(trace, R))
+        / r5[:, None]
+        + 7.5 * np.cross(ORR, R) / (r5 * r2)[:, None]
+    )
+
+
+def tree_field(
+    tree,
+    points,
+    theta=DEFAULT_THETA,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    kernel=_straight_segment_block,
+):
+    """
+    Evaluates the Biot-Savart sum of a tree (see build_tree) at (P, 3) points.
+
+    kernel: Straight-segment kernel to sum the nearby leaves with, see KERNEL_BACKENDS
+
+    The tree is walked for blocks of points at a time, keeping the list of (point, node)
+    pairs still to be resolved as arrays, so every level is handled in array operations.
+
+    Returns a (P, 3) array (without the mu_0 / 4pi factor). Progress is reported as the
+    "integrate" stage, in points.
+    """
+    B = np.zeros((len(points), 3))
+    children = tree["children"]
+    first, last = tree["first"], tree["last"]
+    leaf_size = int(np.max((last - first)[children[:, 0] < 0]))
+    # a leaf is summed directly against up to every point of the block at once
+    point_block = max(1, int(memory_budget) // (BYTES_PER_PAIR * leaf_size))
+    inst = instrumentation.active()
+    inst.progress("integrate", 0, len(points))
+
+    for p in range(0, len(points), point_block):
+        target = points[p : p + point_block]
+        pair_points = np.arange(len(target))
+        pair_nodes = np.zeros(len(target), dtype=int)
+        near_points, near_nodes = [], []
+
+        while len(pair_points):
+            distance = np.sqrt(
+                np.sum((target[pair_points] - tree["center"][pair_nodes]) ** 2, axis=1)
+            )
+            far = tree["radius"][pair_nodes] < theta * distance
+            if np.any(far):
+                field = _multipole_field(
+                    tree, pair_nodes[far], target[pair_points[far]]
+                )
+                for axis in range(3):
+                    B[p : p + point_block, axis] += np.bincount(
+                        pair_points[far], weights=field[:, axis], minlength=len(target)
+                    )
+
+            pair_points, pair_nodes = pair_points[~far], pair_nodes[~far]
+            leaf = children[pair_nodes, 0] < 0
+            near_points.append(pair_points[leaf])
+            near_nodes.append(pair_nodes[leaf])
+            pair_points = np.repeat(pair_points[~leaf], 2)
+            pair_nodes = children[pair_nodes[~leaf]].ravel()
+
+        # sum the nearby leaves exactly, a leaf at a time with all the points close to it
+        near_points = np.concatenate(near_points)
+        near_nodes = np.concatenate(near_nodes)
+        order = np.argsort(near_nodes, kind="stable")
+        near_points, near_nodes = near_points[order], near_nodes[order]
+        leaves, leaf_starts = np.unique(near_nodes, return_index=True)
+        leaf_ends = np.append(leaf_starts[1:], len(near_nodes))
+        for leaf, lo, hi in zip(leaves, leaf_starts, leaf_ends):
+            segments = slice(first[leaf], last[leaf])
+            B[p + near_points[lo:hi]] += kernel(
+                tree["starts"][segments],
+                tree["ends"][segments],
+                tree["currents"][segments],
+                target[near_points[lo:hi]],
+            )
+        inst.progress("integrate", min(p + point_block, len(points)), len(points))
+
+    return B
+
+
+def tree_error(
+    coil,
+    x,
+    y,
+    z,
+    samples=100,
+    seed=0,
+    theta=DEFAULT_THETA,
+    leaf_size=DEFAULT_LEAF_SIZE,
+):
+    """
+    Measures the error of calculate_field(method="tree") against direct summation
+    (method="segment") on a random sample of the points x, y, z.
+
+    Returns a dict with:
+        samples - number of points compared
+        max_error, rms_error - absolute error of the field vector (G)
+        max_relative_error - max_error relative to the largest field in the sample
+    """
+    points, _ = flatten_points(x, y, z)
+    rng = np.random.default_rng(seed)
+    sample = points[rng.choice(len(points), min(samples, len(points)), replace=False)]
+
+    tree_B = calculate_field(
+        coil,
+        sample[:, 0],
+        sample[:, 1],
+        sample[:, 2],
+        method="tree",
+        theta=theta,
+        leaf_size=leaf_size,
+    )
+    direct_B = calculate_field(
+        coil, sample[:, 0], sample[:, 1], sample[:, 2], method="segment"
+    )
+    error = np.sqrt(np.sum((tree_B - direct_B) ** 2, axis=1))
+    return {
+        "samples": len(sample),
+        "max_error": float(np.max(error)),
+        "rms_error": float(np.sqrt(np.mean(error**2))),
+        "max_relative_error": float(
+            np.max(error) / np.max(np.sqrt(np.sum(direct_B**2, axis=1)))
+        ),
+    }